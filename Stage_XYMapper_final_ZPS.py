@@ -1,12 +1,169 @@
 from __future__ import annotations
 import tkinter as tk
-from pylablib.devices import Thorlabs
 from copy import deepcopy
 from tkinter import messagebox
 import threading
-import pywinauto
 from abc import ABC, abstractmethod
 import time
+import random
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import importlib
+import csv
+import io
+import struct
+from array import array
+from datetime import datetime
+from contextlib import nullcontext
+
+
+# pylablib and pywinauto take long to import and are not needed for everything (e.g. mapping with virtual stages),
+# so they are imported only when they are used for the first time.
+class LazyModule():
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+Thorlabs = LazyModule("pylablib.devices.Thorlabs")
+pywinauto = LazyModule("pywinauto")
+handleprops = LazyModule("pywinauto.handleprops")
+np = LazyModule("numpy")
+
+
+# Metrics measures how long the hot operations of a map take (moves, position reads, acquisitions, status polls,
+# UI updates). Every `with metrics.span(name):` adds its duration to a histogram of that name. When metrics are
+# disabled span returns one shared empty context, so the instrumented code costs only that call.
+# The histograms can be exported in the Prometheus text format (.prom, e.g. for the node_exporter textfile collector)
+# or appended as one JSON line per export (any other extension).
+class Metrics():
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60)
+    disabled_span = nullcontext()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.stop_event = threading.Event()
+        self.export_thread = None
+
+    def span(self, name):
+        if not self.enabled:
+            return self.disabled_span
+        return MetricsSpan(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * (len(self.buckets) + 1)}
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            histogram["buckets"][i] += 1
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(histogram, buckets=list(histogram["buckets"])) for name, histogram in self.histograms.items()}
+
+    # Upper bound of the bucket that holds the q-th percentile (max for the last bucket).
+    def percentile(self, histogram, q):
+        target = histogram["count"] * q / 100
+        seen = 0
+        for bound, count in zip(self.buckets, histogram["buckets"]):
+            seen += count
+            if seen >= target:
+                return min(bound, histogram["max"])
+        return histogram["max"]
+
+    # One line per span: count, mean, p90 and max in ms, for the stats panel and the console.
+    def summary_lines(self):
+        lines = []
+        for name, histogram in sorted(self.snapshot().items()):
+            mean = histogram["sum"] / histogram["count"]
+            lines.append(f"{name:<20} {histogram['count']:>7}  mean {mean * 1000:8.1f} ms  "
+                         f"p90 {self.percentile(histogram, 90) * 1000:8.1f} ms  max {histogram['max'] * 1000:8.1f} ms")
+        return lines
+
+    def prometheus_text(self):
+        lines = ["# HELP xymapper_span_seconds Duration of the XYMapper mapping operations.",
+                 "# TYPE xymapper_span_seconds histogram"]
+        for name, histogram in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                cumulative += count
+                lines.append(f'xymapper_span_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'xymapper_span_seconds_bucket{{span="{name}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'xymapper_span_seconds_sum{{span="{name}"}} {histogram["sum"]}')
+            lines.append(f'xymapper_span_seconds_count{{span="{name}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    # A .prom file is replaced atomically, so a scraper never reads half of it.
+    def export(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith(".prom"):
+            temporary = path + ".tmp"
+            with open(temporary, "w") as file:
+                file.write(self.prometheus_text())
+            os.replace(temporary, path)
+        else:
+            with open(path, "a") as file:
+                file.write(json.dumps({"timestamp": time.time(), "buckets": self.buckets, "spans": self.snapshot()}) + "\n")
+
+    # Exports every interval seconds on its own thread until stop_export, which exports once more.
+    def start_export(self, path, interval=10.0):
+        self.stop_export()
+        self.stop_event.clear()
+
+        def run():
+            while not self.stop_event.wait(interval):
+                self.export(path)
+            self.export(path)
+
+        self.export_thread = threading.Thread(target=run, daemon=True)
+        self.export_thread.start()
+
+    def stop_export(self):
+        if self.export_thread is not None:
+            self.stop_event.set()
+            self.export_thread.join()
+            self.export_thread = None
+
+
+class MetricsSpan():
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+metrics = Metrics()
 
 
 ###/////////////////////////////-Main-Code-///////////////////////////////////////////
@@ -14,12 +171,19 @@ import time
 # Stage is the base abstract class for both ThorlabsStage and VirtualStage classes.
 # Stages can move, get id, get current position and update/create their UI.
 class Stage(ABC):
+    profiles_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "motion_profiles.json")
+    default_profiles = {"gentle": {"acceleration": 1.5, "max_velocity": 2.2},
+                        "fast": {"acceleration": 4.0, "max_velocity": 2.6}}
+    long_move_mm = 1.0
+    label_refresh_ms = 200
+
     @abstractmethod
     def __init__(self, id: str, col: int, frame: tk.Frame, state: str):
         self.id = id
         self.col = col
         self.frame = frame
         self.state = state
+        self.ready = True
         
     @abstractmethod
     def move(self):
@@ -51,23 +215,258 @@ class Stage(ABC):
     def get_position(self):
         pass
 
+    # Time of a move with a trapezoidal velocity profile: the stage speeds up with the acceleration, moves at
+    # max_velocity and slows down again. Short moves never reach max_velocity (triangular profile).
+    @staticmethod
+    def trapezoid_time(distance, max_velocity, acceleration):
+        if distance <= 0:
+            return 0
+        if distance <= max_velocity ** 2 / acceleration:
+            return 2 * (distance / acceleration) ** 0.5
+        return distance / max_velocity + max_velocity / acceleration
+
+    # Motion profiles are read from motion_profiles.json. The file has a "default" entry and can have an entry
+    # for a stage serial number (or virtual stage id) that overrides it. Values are in mm/s and mm/s^2.
+    # Moves longer than long_move_mm use the "fast" profile and shorter moves (steps inside a map) the "gentle" one.
+    def read_init_file(self):
+        self.profiles = deepcopy(self.default_profiles)
+        try:
+            with open(self.profiles_path) as file:
+                profiles_file = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Could not read {self.profiles_path}, using default motion profiles: {e}")
+            profiles_file = {}
+        for entry in (profiles_file.get("default", {}), profiles_file.get(str(self.id), {})):
+            self.profiles.update(entry.get("profiles", {}))
+            self.long_move_mm = entry.get("long_move_mm", self.long_move_mm)
+        self.active_profile = None
+        self.apply_profile("gentle")
+
+    # setup_velocity is sent to the motor only when the profile is different from the last one.
+    def apply_profile(self, name):
+        if name == self.active_profile:
+            return
+        profile = self.profiles[name]
+        with self.device_lock:
+            self.motor.setup_velocity(min_velocity=0.0, acceleration=profile["acceleration"] * self.convert,
+                                      max_velocity=profile["max_velocity"] * self.convert)
+        self.active_profile = name
+
+    def profile_for(self, distance):
+        return "fast" if distance > self.long_move_mm else "gentle"
+
+    def select_profile(self, distance):
+        self.apply_profile(self.profile_for(distance))
+
+    def estimate_move_time(self, distance):
+        profile = self.profiles[self.profile_for(distance)]
+        return self.trapezoid_time(distance, profile["max_velocity"], profile["acceleration"])
+
+    # Continuous scanning moves the stage at a constant velocity (mm/s) with the acceleration of the "gentle" profile.
+    # The next normal move sets its profile again.
+    def scan_to(self, end, velocity):
+        acceleration = self.profiles["gentle"]["acceleration"]
+        with self.device_lock:
+            self.motor.setup_velocity(min_velocity=0.0, acceleration=acceleration * self.convert,
+                                      max_velocity=velocity * self.convert)
+            self.motor.move_to(end * self.convert)
+        self.active_profile = None
+
+    def is_moving(self):
+        with self.device_lock:
+            return self.motor.is_moving()
+
+    # Stops the stage right away (without the deceleration ramp), e.g. when a map is aborted.
+    def stop(self):
+        with self.device_lock:
+            self.motor.stop(immediate=True)
+
+    # Keeps the position label live while the stage is moving. For ThorlabsStage it only reads the telemetry cache.
+    def refresh_position_labels(self):
+        try:
+            self.update_position_labels()
+            self.frame.after(self.label_refresh_ms, self.refresh_position_labels)
+        except tk.TclError:
+            pass
+
+    # True if the stage knows its home position, i.e. positions read now are the same as before.
+    @abstractmethod
+    def is_referenced(self):
+        pass
+
+    # get_position may return a cached value, read_position is for motion code that needs the real current position.
+    def read_position(self):
+        return self.get_position
+
+    # self.widgets holds every widget of the stage column, so the column can be moved or removed on reload.
+    def set_column(self, col):
+        self.col = col
+        for widget in self.widgets:
+            widget.grid_configure(column=col)
+
+    def destroy_ui(self):
+        for widget in self.widgets:
+            widget.destroy()
+        self.widgets = []
+
+
+# PositionTelemetry polls the position and status of one controller on its own thread and keeps the last values
+# in a cache. Reading the cache costs no USB traffic, so the UI can read it as often as it wants. A cached value
+# older than ttl seconds is read again from the controller, and get(fresh=True) always reads the controller.
+# device_lock is shared with the stage, so only one thread talks to the controller at a time.
+class PositionTelemetry():
+    def __init__(self, motor, device_lock, rate=10, ttl=0.2):
+        self.motor = motor
+        self.device_lock = device_lock
+        self.period = 1 / rate
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.position = None
+        self.status = []
+        self.timestamp = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Telemetry error: {e}")
+            self.stop_event.wait(self.period)
+
+    # get_position and read_position spans of the stage include the cache, usb_position is the controller read alone
+    # (with the wait for the device lock), also the reads of the telemetry thread.
+    def sample(self):
+        with metrics.span("usb_position"), self.device_lock:
+            position = self.motor.get_position()
+            status = self.motor.get_status()
+        with self.lock:
+            self.position = position
+            self.status = status
+            self.timestamp = time.monotonic()
+        return position
+
+    def get(self, fresh=False):
+        if not fresh:
+            with self.lock:
+                if self.position is not None and time.monotonic() - self.timestamp <= self.ttl:
+                    return self.position
+        return self.sample()
+
+    def is_moving(self):
+        with self.lock:
+            status = self.status
+        return any(state.startswith(("moving", "jogging", "homing")) for state in status)
+
+
+# DeviceStateCache remembers between runs of the program whether a controller (by its serial number) was homed
+# and where it was when the program closed it. It is kept in a small json file next to this script.
+class DeviceStateCache():
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.states = None
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.states = json.load(file)
+        except (OSError, ValueError):
+            self.states = {}
+
+    def get(self, serial):
+        with self.lock:
+            if self.states is None:
+                self.load()
+            return self.states.get(str(serial))
+
+    def update(self, serial, **values):
+        with self.lock:
+            if self.states is None:
+                self.load()
+            state = self.states.setdefault(str(serial), {})
+            state.update(values)
+            state["timestamp"] = time.time()
+            try:
+                with open(self.path, "w") as file:
+                    json.dump(self.states, file, indent=4)
+            except OSError as e:
+                print(f"Could not save the stage state: {e}")
+
 
 # ThorlabsStage class is handling the communication with Thorlabs KDC101 controller through pylablib.Thorlabs.
 # The real stage object is self.motor.
 
 class ThorlabsStage(Stage):
+    telemetry_rate = 10
+    telemetry_ttl = 0.2
+    homing_tolerance = 0.001  # mm
+    state_cache = DeviceStateCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), "stage_state.json"))
+
     def __init__(self, id: str, col: int, frame: tk.Frame, state: str):
         super().__init__(id,col,frame,state)
+        self.device_lock = threading.RLock()
+        self.ready = False
+        self.timings = {}
+        self.widgets = []
+        # Without a frame the stage has no UI, e.g. for mapping from a script.
+        if self.frame is not None:
+            self.connecting_label = tk.Label(self.frame, text=f"Stage {self.id}\nconnecting and homing...")
+            self.connecting_label.grid(column=self.col, row=0, padx=10, pady=10)
+            self.widgets = [self.connecting_label]
+
+    # connect opens and homes the controller. It does not touch the UI, so Stage_app can run it for all
+    # the stages at once on worker threads and call create_ui on the main thread when it is done.
+    # If it fails the controller is closed again, so Reload stages can try to connect it once more.
+    def connect(self):
+        try:
+            self.open_and_home()
+        except Exception:
+            if getattr(self, "motor", None) is not None:
+                try:
+                    with self.device_lock:
+                        self.motor.close()
+                except Exception:
+                    pass
+            raise
+
+    def open_and_home(self):
+        start = time.perf_counter()
         self.motor = Thorlabs.KinesisMotor(self.id, scale= "stage")
-        self.read_init_file()
+        self.timings["open"] = time.perf_counter() - start
+
+        step = time.perf_counter()
+        self.telemetry = PositionTelemetry(self.motor, self.device_lock, rate=self.telemetry_rate, ttl=self.telemetry_ttl)
         self.units = self.motor.get_scale_units()
-        self.create_ui()
         if self.units == "m":
             self.convert = 1 / 1000
             self.units = "mm"
         else:
             self.convert = 1
-        self.stg_home()
+        self.read_init_file()
+        self.timings["setup"] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        if self.homing_needed():
+            self.home_motor()
+        else:
+            print(f"Stage {self.id} is still homed, homing skipped")
+        self.timings["home"] = time.perf_counter() - step
+
+        self.telemetry.start()
+        self.timings["total"] = time.perf_counter() - start
+        self.ready = True
 
 
     def move(self, end, check: bool, update_now: bool):
@@ -88,15 +487,15 @@ class ThorlabsStage(Stage):
         else:
             end = float(end) * self.convert
         
-        self.motor.move_to(end)
+        self.select_profile(abs(end - self.get_position) / self.convert)
+        with self.device_lock:
+            self.motor.move_to(end)
         if update_now == True:
-            self.motor.wait_for_stop()
+            self.wait_for_stop()
             self.update_position_labels()
         try:
-            if self.frame.mapper_window.state() == 'normal':
-                self.frame.mapper.update_canvas_marker()
-                self.frame.mapper.update_position_labels()
-        except:
+            self.frame.mapperUI.post_position_update()
+        except AttributeError:
             pass
     
 
@@ -114,16 +513,77 @@ class ThorlabsStage(Stage):
 
 
     def stage_close(self):
-        self.motor.close()
-
+        if not self.ready:
+            return
+        self.ready = False
+        try:
+            self.state_cache.update(self.id, position=self.read_position())
+        except Exception as e:
+            print(f"Could not save the position of stage {self.id}: {e}")
+        self.telemetry.stop()
+        with self.device_lock:
+            self.motor.close()
+
+
+    # Homing can be skipped only if the saved state says the stage was homed, the controller still reports
+    # that it is homed (it forgets that when it loses power) and it is where the program left it.
+    def homing_needed(self):
+        state = self.state_cache.get(self.id)
+        if state is None or not state.get("homed") or state.get("position") is None:
+            return True
+        with self.device_lock:
+            homed = self.motor.is_homed()
+            position = self.motor.get_position()
+        return not homed or abs(position - state["position"]) > self.homing_tolerance * self.convert
+
+    def is_referenced(self):
+        with self.device_lock:
+            return self.motor.is_homed()
+
+    # The homing command is sent under the lock, but the lock is released while waiting for the end of the homing,
+    # so the telemetry thread (and with it the position labels) is not blocked for the whole homing run.
+    def home_motor(self):
+        with self.device_lock:
+            self.motor.home(sync=False, force=True)
+        while True:
+            with self.device_lock:
+                if self.motor.is_homed() and not self.motor.is_homing():
+                    position = self.motor.get_position()
+                    break
+            time.sleep(0.05)
+        self.state_cache.update(self.id, homed=True, position=position)
 
     def stg_home(self):
-        self.motor.home()
-        self.motor.wait_for_home()
+        self.home_motor()
         self.update_position_labels()
 
+    # Homing takes a while, so the Force home button does it on a separate thread.
+    # The position label keeps updating from the telemetry in the meantime. Go! and Force home are disabled
+    # until the homing is over, and homing is refused while the Mapper is running a map.
+    def force_home(self):
+        mapper = getattr(self.frame, "mapperUI", None)
+        if mapper is not None and mapper.run_start is not None:
+            messagebox.showwarning("Mapping in progress", f"Stage {self.id} can not be homed while a map is running.")
+            return
+        self.moveButton.config(state="disabled")
+        self.homeButton.config(state="disabled")
+        self.homing_thread = threading.Thread(target=self.home_motor, daemon=True)
+        self.homing_thread.start()
+        self.frame.after(200, self.check_homing)
+
+    def check_homing(self):
+        try:
+            if self.homing_thread.is_alive():
+                self.frame.after(200, self.check_homing)
+                return
+            self.moveButton.config(state=self.state)
+            self.homeButton.config(state=self.state)
+        except tk.TclError:
+            pass
+
 
     def create_ui(self):
+        self.connecting_label.destroy()
         self.stage_header = tk.Label(self.frame, text=f"Stage {self.id}", state=self.state)
         self.stage_header.grid(column=self.col, row=0, padx=10, pady=10)
         
@@ -136,33 +596,193 @@ class ThorlabsStage(Stage):
         self.moveButton = tk.Button(self.frame, text="Go!", command=self.move_from_input, state=self.state, height=2, width=10)
         self.moveButton.grid(column=self.col, row=3, padx=10, pady=10)
 
+        self.homeButton = tk.Button(self.frame, text="Force home", command=self.force_home, state=self.state)
+        self.homeButton.grid(column=self.col, row=4, padx=10, pady=10)
+
         self.posLabel = tk.Label(self.frame, text=f"")
-        self.posLabel.config(text=f"Current position: {round(self.get_position, 3)} {self.units}")
         self.posLabel.grid(column=self.col, row=5, padx=10, pady=10)
+        self.widgets = [self.stage_header, self.identify_button, self.inputText, self.moveButton, self.homeButton, self.posLabel]
+        self.refresh_position_labels()
 
 
-    def read_init_file(self):
-        acc = 0.0015
-        velocity = 0.0022
-        self.motor.setup_velocity(min_velocity=0.0,acceleration=acc, max_velocity=velocity)
-
-    def wait_for_stop(self):
-        self.motor.wait_for_stop()
+    # Same as motor.wait_for_stop, but the lock is released between the status checks,
+    # so the telemetry thread can keep sampling the position during the move.
+    # If cancel (a threading.Event) is set, it returns right away even if the stage is still moving.
+    def wait_for_stop(self, cancel=None):
+        while True:
+            with self.device_lock:
+                if not self.motor.is_moving():
+                    return
+            if cancel is None:
+                time.sleep(0.02)
+            elif cancel.wait(0.02):
+                return
     
     @property
     def get_position(self):
-        return self.motor.get_position()
+        with metrics.span("get_position"):
+            return self.telemetry.get()
+
+    def read_position(self):
+        with metrics.span("read_position"):
+            return self.telemetry.get(fresh=True)
+
+
+
+# SimulatedMotor behaves like the KinesisMotor of a KDC101 with a Z825B, but in mm and without any hardware.
+# Moves follow the same trapezoidal velocity profile that Stage.trapezoid_time assumes, the position is calculated
+# from the time since the move started, move_to returns immediately and wait_for_stop blocks until the move is over.
+# Targets outside of the travel range are cut to it, like the controller's software limits do.
+# A move_to during a move starts the new move from the current position at zero velocity.
+# settle_time plays the slow final approach of the controller: the stage is already at the target,
+# but it reports moving for settle_time seconds more.
+class SimulatedMotor():
+    def __init__(self, travel=(0, 25), homing_time=1.0, homing_velocity=2.0, noise=0.0, settle_time=0.0):
+        self.travel = travel
+        self.settle_time = settle_time
+        self.homing_time = homing_time
+        self.homing_velocity = homing_velocity
+        self.noise = noise
+        self.max_velocity = 2.2
+        self.acceleration = 1.5
+        self.lock = threading.Lock()
+        self.start_position = 0
+        self.target = 0
+        self.move_start = 0
+        self.move_duration = 0
+        self.homing = False
+        self.settling = False
+        self.homed = False
+
+    def setup_velocity(self, min_velocity=None, acceleration=None, max_velocity=None):
+        with self.lock:
+            if acceleration is not None:
+                self.acceleration = acceleration
+            if max_velocity is not None:
+                self.max_velocity = max_velocity
+
+    def get_velocity_parameters(self):
+        return (0.0, self.acceleration, self.max_velocity)
+
+    def position_at(self, now):
+        elapsed = now - self.move_start
+        if elapsed >= self.move_duration:
+            return self.target
+        distance = abs(self.target - self.start_position)
+        direction = 1 if self.target >= self.start_position else -1
+        if self.homing:
+            return self.start_position + direction * distance * elapsed / self.move_duration
+        peak = min(self.max_velocity, (distance * self.acceleration) ** 0.5)
+        ramp = peak / self.acceleration
+        if elapsed < ramp:
+            travelled = self.acceleration * elapsed ** 2 / 2
+        elif elapsed < self.move_duration - ramp:
+            travelled = peak * ramp / 2 + peak * (elapsed - ramp)
+        else:
+            travelled = distance - self.acceleration * (self.move_duration - elapsed) ** 2 / 2
+        return self.start_position + direction * travelled
+
+    def move_to(self, position):
+        position = min(max(position, self.travel[0]), self.travel[1])
+        with self.lock:
+            now = time.monotonic()
+            self.start_position = self.position_at(now)
+            self.target = position
+            self.move_start = now
+            self.move_duration = Stage.trapezoid_time(abs(position - self.start_position), self.max_velocity, self.acceleration)
+            self.settling = True
+            self.homing = False
 
+    def get_position(self):
+        with self.lock:
+            position = self.position_at(time.monotonic())
+        if self.noise:
+            position += random.gauss(0, self.noise)
+        return position
+
+    def is_moving(self):
+        with self.lock:
+            return time.monotonic() < self.move_start + self.move_duration + self.settling * self.settle_time
+
+    def wait_for_stop(self, timeout=None):
+        start = time.monotonic()
+        while self.is_moving():
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("Simulated stage did not stop in time")
+            with self.lock:
+                remaining = self.move_start + self.move_duration + self.settling * self.settle_time - time.monotonic()
+            time.sleep(min(max(remaining, 0), 0.05))
+
+    def stop(self, immediate=False):
+        with self.lock:
+            now = time.monotonic()
+            self.target = self.position_at(now)
+            self.start_position = self.target
+            self.move_duration = 0
+            self.settling = False
+            self.homing = False
+
+    # Homing drives the stage to 0 at homing_velocity, plus homing_time for finding the home switch.
+    def home(self, sync=True, force=False, timeout=None):
+        if self.homed and not force:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.start_position = self.position_at(now)
+            self.target = self.travel[0]
+            self.move_start = now
+            self.move_duration = self.homing_time + abs(self.start_position - self.target) / self.homing_velocity
+            self.homing = True
+            self.settling = False
+            self.homed = True
+        if sync:
+            self.wait_for_home(timeout=timeout)
+
+    def wait_for_home(self, timeout=None):
+        self.wait_for_stop(timeout=timeout)
+
+    def is_homed(self):
+        return self.homed and not (self.homing and self.is_moving())
+
+    def is_homing(self):
+        return self.homing and self.is_moving()
+
+    def get_status(self):
+        status = []
+        if self.is_moving():
+            if self.homing:
+                status.append("homing")
+            else:
+                status.append("moving_fw" if self.target >= self.start_position else "moving_bk")
+        if self.is_homed():
+            status.append("homed")
+        return status
+
+    def get_scale_units(self):
+        return "mm"
+
+    def close(self):
+        pass
 
 
 # For the purpose of testing, the program can handle virtual stages. You can add them using a button "add virtual stage".
-# Instead of having a real position like Thorlabs stage, virtual stage has a variable self.position.
-# For increased realness, a delay is added to a move of a virtual stage, to simulate real movement.
+# Instead of a KDC101 controller a virtual stage has a SimulatedMotor, which moves with the same velocity profiles
+# as a real stage, so moving and mapping with virtual stages takes about as long as with real ones.
 class VirtualStage(Stage):
+    homing_time = 1.0
+    position_noise = 0.0  # mm
+    settle_time = 0.0  # s
+
     def __init__(self, id: str, col: int, frame: tk.Frame, state: str):
         super().__init__(id,col,frame,state)
-        self.position = 0
-        self.create_ui()
+        self.device_lock = threading.RLock()
+        self.motor = SimulatedMotor(homing_time=self.homing_time, noise=self.position_noise, settle_time=self.settle_time)
+        self.blink_until = 0
+        self.read_init_file()
+        self.motor.home(sync=False)
+        # Without a frame the stage has no UI, e.g. for mapping without any window.
+        if self.frame is not None:
+            self.create_ui()
 
     
     def move(self,end,check,update_now):
@@ -182,18 +802,16 @@ class VirtualStage(Stage):
                     end = float(new_end)
         else:
             end = float(end)
-        self.position = end
 
+        self.select_profile(abs(end - self.get_position))
+        self.motor.move_to(end)
         if update_now == True:
+            self.wait_for_stop()
             self.update_position_labels()
         try:
-            if self.frame.mapper_window.state() == 'normal':
-                self.frame.mapper.update_canvas_marker()
-                self.frame.mapper.update_position_labels()
-        except:
+            self.frame.mapperUI.post_position_update()
+        except AttributeError:
             pass
-
-        time.sleep(0.2)
     
     
     def move_from_input(self):
@@ -202,7 +820,9 @@ class VirtualStage(Stage):
     
     
     def update_position_labels(self):
-        self.posLabel.config(text=f"Current position: {self.get_position} mm")
+        if time.monotonic() < self.blink_until:
+            return
+        self.posLabel.config(text=f"Current position: {round(self.get_position, 3)} mm")
 
     @property
     def id_get(self):
@@ -210,10 +830,11 @@ class VirtualStage(Stage):
 
     @property
     def get_position(self):
-        return self.position
+        with metrics.span("get_position"):
+            return self.motor.get_position()
     
     def stage_close(self):
-        pass
+        self.motor.stop()
 
     
     def create_ui(self):
@@ -230,14 +851,23 @@ class VirtualStage(Stage):
         self.moveButton.grid(column=self.col, row=3, padx=10, pady=10)
 
         self.posLabel = tk.Label(self.frame, text="")
-        self.posLabel.config(text=f"Current position: {self.get_position} mm")
         self.posLabel.grid(column=self.col, row=5, padx=10, pady=10)
+        self.widgets = [self.stage_header, self.identify_button, self.inputText, self.moveButton, self.posLabel]
+        self.refresh_position_labels()
 
     def blink(self):
+        self.blink_until = time.monotonic() + 1
         self.posLabel.config(text = "It's me!")
 
-    def wait_for_stop(self):
-        pass
+    def wait_for_stop(self, cancel=None):
+        if cancel is None:
+            self.motor.wait_for_stop()
+            return
+        while self.motor.is_moving() and not cancel.wait(0.02):
+            pass
+
+    def is_referenced(self):
+        return self.motor.is_homed()
     
     @property
     def convert(self):
@@ -255,6 +885,8 @@ class Stage_app(tk.Tk):
         self.mapper_control = 0
         self.label_namelist = self._idlist+self._virtual_idlist
         self.mapper_button_present = False
+        self.pending_stages = []
+        self.label_list = []
 
         for i in range(len(self._devices)):
             self._idlist.append(self._devices[i][0])
@@ -279,6 +911,7 @@ class Stage_app(tk.Tk):
 
 
         self.initialize_stages(add_virtual=False)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         
         
 
@@ -303,6 +936,15 @@ class Stage_app(tk.Tk):
         except:
             pass
 
+    # Closing the stages saves their last positions, so the next start can skip homing.
+    def on_close(self):
+        for stage in self.stage_list:
+            try:
+                stage.stage_close()
+            except Exception as e:
+                print(f"Stage {stage.id} was not closed properly: {e}")
+        self.destroy()
+
     def update_label_position(self):
         self.label_namelist = self._idlist + self._virtual_idlist
         self.reload_stages_button.grid(row=len(self.label_namelist)+2)
@@ -311,11 +953,56 @@ class Stage_app(tk.Tk):
 
 
 
+    # Reload compares the connected controllers with the stages that are already open. Only the controllers
+    # that were plugged in are opened and homed, and only the unplugged ones are closed. A stage that could not
+    # connect is removed and added again, so it is connected once more. Virtual stages, the other stages and
+    # an open Mapper window are left as they are.
     def stage_reload(self):
-        self.stage_finish(close_virtual=True)
-        self.stage_finish(close_virtual=False)
-        self.destroy()
-        self.__init__()
+        self._devices = Thorlabs.list_kinesis_devices()
+        serials = [device[0] for device in self._devices]
+        connecting = [stage for stage, future in self.pending_stages]
+        failed = [stage for stage in self.stage_list if isinstance(stage, ThorlabsStage) and not stage.ready
+                  and stage not in connecting and stage.id in serials]
+        removed = [stage for stage in self.stage_list if isinstance(stage, ThorlabsStage) and stage.id not in serials]
+        removed += failed
+        added = [serial for serial in serials if serial not in self._idlist or serial in [stage.id for stage in failed]]
+
+        for stage in removed:
+            try:
+                stage.stage_close()
+            except Exception as e:
+                print(f"Stage {stage.id} was not closed properly: {e}")
+            stage.destroy_ui()
+            self.stage_list.remove(stage)
+            self._idlist.remove(stage.id)
+            if stage in getattr(self, "stages_for_mapping", []):
+                messagebox.showwarning("Stage disconnected", f"Stage {stage.id} used by the Mapper was disconnected!")
+
+        new_stages = []
+        for serial in added:
+            stage = ThorlabsStage(id=serial, col=len(self._idlist)+1, frame=self, state="normal")
+            self.stage_list.insert(len(self._idlist), stage)
+            self._idlist.append(serial)
+            new_stages.append(stage)
+
+        for i, stage in enumerate(self.stage_list):
+            stage.set_column(i+1)
+        self.refresh_stage_labels()
+        self.connect_stages(new_stages)
+        retried = [stage.id for stage in failed]
+        print(f"Reloaded stages, added: {[serial for serial in added if serial not in retried]}, "
+              f"removed: {[stage.id for stage in removed if stage not in failed]}, retried: {retried}")
+
+    def refresh_stage_labels(self):
+        for label in self.label_list:
+            if isinstance(label, tk.Label):
+                label.destroy()
+        self.label_namelist = self._idlist + self._virtual_idlist
+        self.label_list = []
+        for i, name in enumerate(self.label_namelist):
+            self.label_list.append(tk.Label(text=f"{i}: {name}"))
+            self.label_list[-1].grid(column=0, row=i+1, padx=10, pady=10)
+        self.update_label_position()
 
     def initialize_stages(self,add_virtual: bool):
         self.label_namelist = self._idlist + self._virtual_idlist
@@ -337,10 +1024,50 @@ class Stage_app(tk.Tk):
                 self.stage_list.append(ThorlabsStage(id=self._idlist[i],col = len(self.stage_list)+1, frame=self,state="normal"))
                 self.label_list[i] = tk.Label(text=f"{i}: {self._idlist[i]}")
                 self.label_list[i].grid(column=0, row = i+1,padx=10,pady=10)
+            self.connect_stages(self.stage_list)
 
             
         self.update_label_position()
 
+    # All the controllers are opened and homed at the same time on a thread pool. The main loop checks the
+    # pool with after() and builds the UI column of every stage as soon as that stage is ready.
+    def connect_stages(self, stages):
+        if not stages:
+            return
+        self.connect_start = time.perf_counter()
+        pool = ThreadPoolExecutor(max_workers=len(stages))
+        pending = [(stage, pool.submit(stage.connect)) for stage in stages]
+        pool.shutdown(wait=False)
+        if not self.pending_stages:
+            self.after(50, self.check_connected_stages)
+        self.pending_stages.extend(pending)
+
+    def check_connected_stages(self):
+        pending = []
+        for stage, future in self.pending_stages:
+            if not future.done():
+                pending.append((stage, future))
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Stage {stage.id} could not be initialized: {e}")
+                if stage in self.stage_list:
+                    stage.connecting_label.config(text=f"Stage {stage.id}\ncould not connect")
+                continue
+            if stage not in self.stage_list:
+                # The controller was unplugged and reloaded while it was still homing.
+                stage.stage_close()
+                continue
+            stage.create_ui()
+            timings = ", ".join(f"{name} {round(value,2)} s" for name, value in stage.timings.items())
+            print(f"Stage {stage.id} ready: {timings}")
+        self.pending_stages = pending
+        if pending:
+            self.after(50, self.check_connected_stages)
+        else:
+            print(f"All stages initialized in {round(time.perf_counter() - self.connect_start,2)} s")
+
 
     def resolution_picker(self):
         if len(self._idlist) == 2:
@@ -365,6 +1092,11 @@ class Stage_app(tk.Tk):
             self.checkbox_var_list.append(tk.IntVar())
             self.checkbox_list.append(tk.Checkbutton(self.popup,text = self.label_namelist[i],variable=self.checkbox_var_list[i],onvalue=1, offvalue=0))
             self.checkbox_list[i].grid(column=0, row= i+1,padx=10,pady=10)
+        self.detector_var = tk.StringVar(self, Mapper.detector_names[0])
+        self.choose_detector_label = tk.Label(self.popup,text="Detector:")
+        self.choose_detector_label.grid(column=1,row=0,padx=10,pady=10)
+        self.choose_detector_menu = tk.OptionMenu(self.popup, self.detector_var, *Mapper.detector_names)
+        self.choose_detector_menu.grid(column=1,row=1,padx=10,pady=10)
         self.submit_stages_for_mapping_button = tk.Button(self.popup, text="Submit",command=self.popup.destroy)
         self.submit_stages_for_mapping_button.grid(column = 0, row= len(self.stage_list)+2,padx=10,pady=10)
 
@@ -399,26 +1131,124 @@ class Stage_app(tk.Tk):
                         
                         return
 
+                if not all(stage.ready for stage in self.stages_for_mapping):
+                        messagebox.showinfo("Mapping Not Possible", "Stages are still connecting and homing!")
+                        return
+
                 self.mapper_window = tk.Toplevel(self)
                 self.mapper_window.title(f"Mapping with stages: {self.stages_for_mapping_namelist[0]}, {self.stages_for_mapping_namelist[1]}")
-                self.mapper = Mapper(self.stages_for_mapping)
+                self.mapper = Mapper(self.stages_for_mapping, detector=Mapper.create_detector(self.detector_var.get()))
                 self.mapperUI = MapperUI(frame=self.mapper_window,mapper=self.mapper)
             
             
+# Region is the base abstract class for the shapes that limit a map to a part of the sample (e.g. a round sample).
+# contains gets an (N,2) numpy array of points in mm and returns a boolean array, True for the points to map.
+class Region(ABC):
+    @abstractmethod
+    def contains(self, points):
+        pass
+
+
+class CircleRegion(Region):
+    def __init__(self, center, radius):
+        self.center = np.asarray(center, dtype=float)
+        self.radius = radius
+
+    def contains(self, points):
+        return ((points - self.center) ** 2).sum(axis=1) <= self.radius ** 2 + 1e-12
+
+
+# Even-odd rule: a point is inside if a ray from it crosses the edges of the polygon an odd number of times.
+# The loop goes over the edges, every edge is checked for all the points at once.
+class PolygonRegion(Region):
+    def __init__(self, vertices):
+        self.vertices = np.asarray(vertices, dtype=float)
+
+    def contains(self, points):
+        x, y = points[:, 0], points[:, 1]
+        inside = np.zeros(len(points), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(self.vertices, np.roll(self.vertices, -1, axis=0)):
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (x < x_cross)
+        return inside
+
+
+# mask is a 2D array (e.g. a thresholded camera image of the sample), mask[row][column] is true where the sample is.
+# Pixel (column,row) covers x from origin_x + column * pixel_size and y from origin_y + row * pixel_size (in mm).
+class BitmapRegion(Region):
+    def __init__(self, mask, origin, pixel_size):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.origin = origin
+        self.pixel_size = pixel_size
+
+    def contains(self, points):
+        columns = np.floor((points[:, 0] - self.origin[0]) / self.pixel_size).astype(int)
+        rows = np.floor((points[:, 1] - self.origin[1]) / self.pixel_size).astype(int)
+        inside = (rows >= 0) & (rows < self.mask.shape[0]) & (columns >= 0) & (columns < self.mask.shape[1])
+        result = np.zeros(len(points), dtype=bool)
+        result[inside] = self.mask[rows[inside], columns[inside]]
+        return result
+
+
 # Mapper is a class to handle the mapping process (not the UI of Mapper!). It handles the simultanous movement of stages,
 # creating list of points to map, starting the mapping process etc.
 class Mapper():
-    def __init__(self, stages):
+    detector_names = ("Chirascan", "Simulated")
+
+    def __init__(self, stages, detector=None):
         self.stages = stages
-        self.mapping_points_on_map = 0
         self.map_list = []
-        self.circle_id_list = []
+        self.abort_event = threading.Event()
+        self.mapping_error = None
+        self.mapping_failure = None
+        self.abort_requested = None
+        self.abort_latency = None
+        self.run_plan = None
 
         self.x_step = 0
         self.y_step = 0
+        self.path_strategies = ("raster", "serpentine", "nearest", "2-opt")
+        self.path_strategy = "serpentine"
+        self.fast_axis = "y"
+        self.two_opt_passes = 3
+        self.two_opt_max_points = 500
+        self.nearest_max_points = 10000
+        self.travel_distance = 0
+        self.travel = (0, 25)
+        self.region = None
+        self.map_array = np.zeros((0, 2))
         self.stage_x = self.stages[0]
         self.stage_y = self.stages[1]
-        self.spectro = Chirascan()
+        self.spectro = detector if detector is not None else Chirascan.shared()
+        self.acquisition_waiter = AcquisitionWaiter(self.spectro.GetStatus, ready_status=self.spectro.ready_status,
+                                                    cancel=self.abort_event)
+        self.default_acquisition_time = 2.0
+        self.move_correction = 0
+        self.run_start = None
+        self.points_done = 0
+        self.record_format = "csv"
+        self.results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "map_results")
+        self.recorder = None
+        self.mapping_modes = ("grid", "adaptive", "continuous")
+        self.mapping_mode = "grid"
+        self.adaptive_threshold = None
+        self.adaptive_fraction = 0.1
+        self.adaptive_max_depth = 3
+        self.adaptive_max_points = 2000
+        self.signals = {}
+        self.continuous_margin = 1.2
+        self.continuous_poll_interval = 0.005
+        self.settle_tolerance = None
+        self.settle_dwell = 0.05
+        self.settle_timeout = 1.0
+        self.settle_poll_interval = 0.01
+        self.settle_watcher = SettleWatcher(self.stages_moving, self.settle_poll_interval)
+        self.settle_savings = []
+        self.metrics_path = None
+        self.metrics_interval = 10.0
 
 
     def move_to_position(self, x, y):
@@ -426,72 +1256,765 @@ class Mapper():
         motor_y = y / 10
         self.move_two_at_once((motor_x,motor_y))
 
-    def start_mapping(self):
+    # mapping_terminated is kept in abort_event, so every wait of the mapping thread can wake up as soon as it is set.
+    @property
+    def mapping_terminated(self):
+        return self.abort_event.is_set()
+
+    @mapping_terminated.setter
+    def mapping_terminated(self, value):
+        if value:
+            self.abort_event.set()
+        else:
+            self.abort_event.clear()
+
+    # Abort wakes up the waits of the mapping thread, stops both stages and the running acquisition right away.
+    # The time until the mapping thread really stopped is printed at the end of mapping_process (abort_latency).
+    def abort_mapping(self):
+        self.abort_requested = time.monotonic()
+        self.mapping_terminated = True
+        self.stop_stages()
+        try:
+            self.spectro.StopMeasurement()
+        except Exception as e:
+            print(f"Could not stop the measurement: {e}")
+
+    def stop_stages(self):
+        for stage in (self.stage_x, self.stage_y):
+            try:
+                stage.stop()
+            except Exception as e:
+                print(f"Could not stop stage {stage.id}: {e}")
+
+    def start_mapping(self, start_index=0):
+        if self.mapping_running():
+            raise RuntimeError("A map is already running")
         self.mapping_terminated = False
-        self.mapping_thread = threading.Thread(target=self.mapping_process)
+        self.mapping_error = None
+        self.mapping_failure = None
+        # A Kill Mapping pressed while no map was running must not count as an abort of this map.
+        self.abort_requested = None
+        self.abort_latency = None
+        self.mapping_thread = threading.Thread(target=self.run_mapping, args=(start_index,))
         self.mapping_thread.start()
 
-    def create_map_list(self,map_parameters):
+    def mapping_running(self):
+        thread = getattr(self, "mapping_thread", None)
+        return thread is not None and thread.is_alive()
+
+    # An exception on the mapping thread is kept in mapping_error, so whoever waits for the thread can see the map failed.
+    # A map that stopped without an exception and without an abort (e.g. a measurement timeout) has the reason in
+    # mapping_failure.
+    def run_mapping(self, start_index=0):
+        try:
+            self.mapping_process(start_index)
+        except Exception as e:
+            self.mapping_error = e
+            raise
+
+    # The map starts at origin (x, y in mm), by default at the current position of the stages.
+    def create_map_list(self,map_parameters,origin=None):
         self.map_list = []
+        self.map_parameters = list(map_parameters)
         x_range,y_range,x_points,y_points = map_parameters
-        try:
-            x_step = x_range / (x_points - 1)
-            y_step = y_range / (y_points - 1)
-        except:
-            if x_points == 1:
-                x_step = 0
-            if y_points == 1:
-                y_step = 0
-            
-        motor_x = self.converted_position(self.stage_x)
-        motor_y = self.converted_position(self.stage_y)
+        x_step = x_range / (x_points - 1) if x_points > 1 else 0
+        y_step = y_range / (y_points - 1) if y_points > 1 else 0
             
-        for i in range(x_points):
-            for j in range(y_points):
-                x_coord = motor_x + i * x_step
-                y_coord = motor_y + j * y_step
-                self.map_list.append((x_coord,y_coord))
+        if origin is None:
+            origin = (self.converted_position(self.stage_x), self.converted_position(self.stage_y))
+        motor_x, motor_y = origin
+        self.map_origin = (motor_x, motor_y)
+        self.map_step = (x_step, y_step)
+
+        # The grid is made with numpy, one row of the grid is one line along the fast axis, so raster and
+        # serpentine orders only differ in the direction every second row is walked.
+        xs = motor_x + np.arange(x_points) * x_step
+        ys = motor_y + np.arange(y_points) * y_step
+        if self.fast_axis == "x":
+            grid_x, grid_y = np.meshgrid(xs, ys)
+        else:
+            grid_y, grid_x = np.meshgrid(ys, xs)
+        if self.path_strategy != "raster":
+            grid_x[1::2] = grid_x[1::2, ::-1]
+            grid_y[1::2] = grid_y[1::2, ::-1]
+        points = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+
+        # Points outside of the region are dropped before anything moves. Masking keeps the order of the points.
+        if self.region is not None:
+            points = points[self.region.contains(points)]
+        self.map_array = points
+        self.map_list = points.tolist()
+
+        if self.path_strategy == "nearest" and len(self.map_list) <= self.nearest_max_points:
+            self.map_list = self.order_nearest_neighbour(self.map_list, (motor_x, motor_y))
+        if self.path_strategy == "2-opt" and len(self.map_list) <= self.two_opt_max_points:
+            self.map_list = self.order_two_opt(self.map_list, (motor_x, motor_y))
+        if self.path_strategy in ("nearest", "2-opt"):
+            self.map_array = np.asarray(self.map_list, dtype=float).reshape(-1, 2)
+
+        self.travel_distance = self.path_length(self.map_array, (motor_x, motor_y))
         return self.map_list
 
-    def mapping_process(self):
-        self.create_map_list()
-        for coordinate in self.map_list:
-            if coordinate[0]> 25 or coordinate[0] < 0 or coordinate[1] > 25 or coordinate[1] < 0:
-                proceed = messagebox.askyesno("Out of bounds!", "Mapping area is out of bounds! Some points will be lost. Proceed anyway?")
-                if proceed == False:
-                    return
+    # Both stages move at the same time, so the time of a single move is set by the longer axis.
+    # That is why the distance between two points is measured as max(|dx|,|dy|) and not as a straight line.
+    @staticmethod
+    def move_distance(start, end):
+        return max(abs(end[0] - start[0]), abs(end[1] - start[1]))
+
+    def path_length(self, points, start=None):
+        if len(points) == 0:
+            return 0
+        path = np.asarray(points, dtype=float)
+        if start is not None:
+            path = np.vstack((start, path))
+        return float(np.abs(np.diff(path, axis=0)).max(axis=1).sum())
+
+    # Nearest neighbour measures the distance from the current point to all the points at once with numpy, a visited
+    # point is moved to infinity so it is never the nearest again. It is still O(n^2), so it is skipped for maps
+    # bigger than nearest_max_points.
+    def order_nearest_neighbour(self, points, start):
+        xs, ys = np.array(points, dtype=float).reshape(-1, 2).T.copy()
+        order = []
+        current_x, current_y = start
+        for _ in range(len(xs)):
+            nearest = int(np.maximum(np.abs(xs - current_x), np.abs(ys - current_y)).argmin())
+            order.append(nearest)
+            current_x, current_y = xs[nearest], ys[nearest]
+            xs[nearest] = ys[nearest] = np.inf
+        return [list(points[k]) for k in order]
+
+    # 2-opt starts from the serpentine order and reverses parts of the path as long as it makes the path shorter. It is O(n^2) per pass,
+    # so it gives up after max_passes and is skipped for maps bigger than two_opt_max_points.
+    def order_two_opt(self, points, start, max_passes=None):
+        if max_passes is None:
+            max_passes = self.two_opt_passes
+        path = [start] + list(points)
+        for _ in range(max_passes):
+            improved = False
+            for i in range(1, len(path) - 2):
+                for j in range(i + 1, len(path) - 1):
+                    before = self.move_distance(path[i - 1], path[i]) + self.move_distance(path[j], path[j + 1])
+                    after = self.move_distance(path[i - 1], path[j]) + self.move_distance(path[i], path[j + 1])
+                    if after < before - 1e-12:
+                        path[i:j + 1] = reversed(path[i:j + 1])
+                        improved = True
+            if not improved:
+                break
+        return path[1:]
+
+    # Returns the travel distance of every path strategy, None for a strategy that is skipped for a map of this size
+    # (the map would keep the serpentine order, so its distance says nothing about the strategy).
+    def compare_path_strategies(self, map_parameters):
+        chosen = self.path_strategy
+        limits = {"nearest": self.nearest_max_points, "2-opt": self.two_opt_max_points}
+        distances = {}
+        try:
+            for strategy in self.path_strategies:
+                self.path_strategy = strategy
+                Mapper.create_map_list(self, map_parameters)
+                if len(self.map_list) > limits.get(strategy, len(self.map_list)):
+                    distances[strategy] = None
                 else:
-                    break
-        for coordinate in self.map_list:
+                    distances[strategy] = self.travel_distance
+        finally:
+            self.path_strategy = chosen
+            Mapper.create_map_list(self, map_parameters)
+        return distances
+
+    def out_of_bounds_mask(self):
+        return np.any((self.map_array < self.travel[0]) | (self.map_array > self.travel[1]), axis=1)
+
+    def points_out_of_bounds(self):
+        return bool(self.out_of_bounds_mask().any())
+
+    def drop_out_of_bounds(self):
+        inside = ~self.out_of_bounds_mask()
+        self.map_array = self.map_array[inside]
+        self.map_list = [point for point, keep in zip(self.map_list, inside.tolist()) if keep]
+
+    # mapping_process runs on its own thread and maps the points from self.map_list, which has to be
+    # created (and checked with points_out_of_bounds) before start_mapping is called.
+    # start_index is the first point of self.map_list to map, it is not 0 when an interrupted map is resumed.
+    # The plan is copied at the start (plan_snapshot) and the mapping only reads the copy, so a new map_list
+    # made while the map runs cannot change it.
+    def mapping_process(self, start_index=0):
+        plan = self.plan_snapshot()
+        self.run_plan = plan
+        self.prepare_estimate(plan)
+        self.run_start = time.monotonic()
+        self.run_first_index = start_index
+        self.points_done = start_index
+        self.move_times = []
+        self.run_acquisition_times = []
+        self.settle_savings = []
+        finished = False
+        # An adaptive map is not checkpointed, its points are only known while it runs.
+        adaptive = plan["mapping_mode"] == "adaptive"
+        if start_index == 0:
+            self.recorder = self.create_recorder()
+            if not adaptive:
+                self.save_checkpoint_plan(plan)
+        else:
+            self.recorder = self.create_recorder(self.checkpoint_plan.get("log"))
+        if metrics.enabled:
+            metrics.start_export(self.metrics_path or os.path.join(self.results_dir, "metrics.prom"), self.metrics_interval)
+        try:
+            if adaptive:
+                finished = self.map_adaptive(plan)
+            elif plan["mapping_mode"] == "continuous":
+                finished = self.map_continuous(plan, start_index)
+            else:
+                finished = self.map_points(plan["map_list"], start_index)
+        finally:
+            elapsed = time.monotonic() - self.run_start
+            self.run_start = None
+            self.settle_watcher.end()
+            if self.abort_requested is not None:
+                # A move or an acquisition could have been started just after the stop, so both are stopped once more.
+                self.stop_stages()
+                try:
+                    self.spectro.StopMeasurement()
+                except Exception as e:
+                    print(f"Could not stop the measurement: {e}")
+                self.abort_latency = time.monotonic() - self.abort_requested
+                self.abort_requested = None
+                print(f"Mapping aborted in {round(self.abort_latency * 1000)} ms")
+            if self.recorder is not None:
+                self.recorder.close()
+            metrics.stop_export()
+            if finished and not adaptive:
+                self.clear_checkpoint()
+            self.report_estimate(elapsed, plan)
+
+    def create_recorder(self, path=None):
+        if self.record_format is None:
+            return None
+        if path is None:
+            os.makedirs(self.results_dir, exist_ok=True)
+            extension = "csv" if self.record_format == "csv" else "bin"
+            path = os.path.join(self.results_dir, f"map_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}")
+        print(f"Saving mapped points to {path}")
+        return PointRecorder(path, format=self.record_format)
+
+    # A running map is checkpointed in two files: the plan (written once at the start) and the number of completed
+    # points (rewritten after every point). If the map is interrupted, resume_mapping continues from there.
+    # The checkpoint is removed when the map finishes.
+    def checkpoint_path(self, name):
+        return os.path.join(self.results_dir, f"checkpoint_{name}.json")
+
+    def write_json(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(data, file)
+        os.replace(temporary, path)
+
+    # The plan of a run: the points and everything the mapping thread needs to know about how they were made.
+    def plan_snapshot(self):
+        parameters = getattr(self, "map_parameters", None)
+        return {
+            "parameters": list(parameters) if parameters is not None else None,
+            "origin": getattr(self, "map_origin", None),
+            "step": getattr(self, "map_step", None),
+            "path_strategy": self.path_strategy,
+            "fast_axis": self.fast_axis,
+            "mapping_mode": self.mapping_mode,
+            "map_list": list(self.map_list),
+        }
+
+    def save_checkpoint_plan(self, plan):
+        self.checkpoint_plan = {
+            "created": time.time(),
+            "stages": [self.stage_x.id, self.stage_y.id],
+            "parameters": plan["parameters"],
+            "origin": plan["origin"],
+            "path_strategy": plan["path_strategy"],
+            "fast_axis": plan["fast_axis"],
+            "mapping_mode": plan["mapping_mode"],
+            "log": self.recorder.path if self.recorder is not None else None,
+            "map_list": plan["map_list"],
+        }
+        self.write_json(self.checkpoint_path("plan"), self.checkpoint_plan)
+        self.save_checkpoint_progress(0)
+
+    def save_checkpoint_progress(self, completed):
+        self.write_json(self.checkpoint_path("progress"), {"completed": completed, "time": time.time()})
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path("plan")) as file:
+                plan = json.load(file)
+            with open(self.checkpoint_path("progress")) as file:
+                completed = json.load(file)["completed"]
+        except (OSError, ValueError, KeyError):
+            return None, 0
+        return plan, completed
+
+    def clear_checkpoint(self):
+        for name in ("plan", "progress"):
+            try:
+                os.remove(self.checkpoint_path(name))
+            except OSError:
+                pass
+
+    # Returns None if the saved map can be resumed, otherwise the reason why not. The map is saved in stage
+    # coordinates, so it can only be continued with the same stages and if they did not lose their home reference.
+    def check_resume(self, plan, completed):
+        if plan is None:
+            return "There is no interrupted map to resume."
+        if completed >= len(plan["map_list"]):
+            return "The saved map is already finished."
+        if plan["stages"] != [self.stage_x.id, self.stage_y.id]:
+            return f"The saved map was made with stages {plan['stages'][0]}, {plan['stages'][1]}."
+        if not (self.stage_x.is_referenced() and self.stage_y.is_referenced()):
+            return "The stages are not homed anymore, the position of the saved map is lost."
+        return None
+
+    def resume_mapping(self):
+        if self.mapping_running():
+            return "A map is already running."
+        plan, completed = self.load_checkpoint()
+        problem = self.check_resume(plan, completed)
+        if problem is not None:
+            return problem
+        self.checkpoint_plan = plan
+        self.map_list = plan["map_list"]
+        self.map_array = np.asarray(self.map_list, dtype=float).reshape(-1, 2)
+        self.path_strategy = plan["path_strategy"]
+        self.fast_axis = plan["fast_axis"]
+        self.mapping_mode = plan.get("mapping_mode", "grid")
+        print(f"Resuming the map from point {completed + 1} of {len(self.map_list)}")
+        self.start_mapping(start_index=completed)
+        return None
+
+    def record_point(self, index, coordinate, actual, move_time, acquisition_time, status, signal=None, settle_saved=None):
+        if self.recorder is None:
+            return
+        record = dict(index=index, timestamp=time.time(), x_commanded=coordinate[0], y_commanded=coordinate[1],
+                      x_actual=actual[0], y_actual=actual[1], move_s=move_time, acquisition_s=acquisition_time, status=status)
+        if signal is not None:
+            record["signal"] = signal
+        if settle_saved is not None:
+            record["settle_saved_s"] = settle_saved
+        self.recorder.add(**record)
+
+    def map_points(self, points, start_index=0):
+        for index in range(start_index, len(points)):
             if self.mapping_terminated:
-                return
-            print(f"Moving to point: ({round(coordinate[0],3)}, {round(coordinate[1],3)})")
-            self.move_two_at_once(coordinate)
-            
-            self.take_spectrum()
-            time.sleep(2)
-            while True:
-                if self.spectro.GetStatus() == 'Ready.':
-                    break
-                else:
-                    print(f'Measurement is being taken')
-                    time.sleep(1)
-                
+                return False
+            if not self.map_point(index, points[index]):
+                return False
+            self.save_checkpoint_progress(self.points_done)
 
         print("Mapping finished :)")
+        return True
+
+    # Moves to one point and measures it. Returns False if the measurement did not finish.
+    # In adaptive mode the signal of the detector (None if it has none) is kept in self.signals for the refinement.
+    def map_point(self, index, coordinate):
+        print(f"Moving to point: ({round(coordinate[0],3)}, {round(coordinate[1],3)})")
+        move_start = time.monotonic()
+        self.move_two_at_once(coordinate)
+        move_time = time.monotonic() - move_start
+        if self.mapping_terminated:
+            # The move was cut short, so it is not used to correct the move predictions.
+            return False
+        self.move_times.append(move_time)
+
+        self.take_spectrum()
+        try:
+            with metrics.span("acquisition_wait"):
+                acquisition_time = self.acquisition_waiter.wait()
+        except TimeoutError:
+            actual = (self.actual_position(self.stage_x), self.actual_position(self.stage_y))
+            self.record_point(index, coordinate, actual, move_time, self.acquisition_waiter.timeout, "timeout")
+            self.mapping_failure = f"Measurement did not finish in {self.acquisition_waiter.timeout} s"
+            print(f"{self.mapping_failure}, mapping stopped.")
+            return False
+        if acquisition_time is None:
+            actual = (self.actual_position(self.stage_x), self.actual_position(self.stage_y))
+            self.record_point(index, coordinate, actual, move_time, float("nan"), "aborted")
+            return False
+        actual = (self.actual_position(self.stage_x), self.actual_position(self.stage_y))
+        signal = self.spectro.Signal(actual)
+        if self.run_plan["mapping_mode"] == "adaptive":
+            self.signals[self.point_key(coordinate)] = signal
+        self.run_acquisition_times.append(acquisition_time)
+        settle_saved = self.settle_saved()
+        self.record_point(index, coordinate, actual, move_time, acquisition_time, self.spectro.ready_status, signal,
+                          settle_saved)
+        self.points_done += 1
+        print(f"Measurement took {round(acquisition_time,2)} s")
+        return True
+
+    def point_key(self, coordinate):
+        return (round(coordinate[0], 6), round(coordinate[1], 6))
+
+    # Adaptive mapping starts with the grid from create_map_list (the coarse pass). Every cell of the grid (the rectangle
+    # between 4 neighbouring points) in which the signal changes by more than the threshold is split in 4, and the
+    # new points of all split cells are mapped in the next pass. This repeats until no cell changes enough,
+    # adaptive_max_depth passes were done or adaptive_max_points would be exceeded (then the cells with the biggest
+    # change are split first). The threshold is adaptive_threshold, or adaptive_fraction of the signal range of the
+    # coarse pass if it is None. It needs a detector that returns a signal (Detector.Signal).
+    def map_adaptive(self, plan):
+        self.signals = {}
+        coarse = list(plan["map_list"])
+        for coordinate in coarse:
+            if self.mapping_terminated or not self.map_point(self.points_done, coordinate):
+                return False
+
+        values = [value for value in self.signals.values() if value is not None]
+        if len(values) < len(self.signals):
+            print("The detector does not return a signal, the map was not refined.")
+            print("Mapping finished :)")
+            return True
+        threshold = self.adaptive_threshold
+        if threshold is None:
+            threshold = self.adaptive_fraction * (max(values) - min(values)) if values else 0
+
+        x_range, y_range, x_points, y_points = plan["parameters"]
+        origin_x, origin_y = plan["origin"]
+        x_step, y_step = plan["step"]
+        cells = [(origin_x + i * x_step, origin_y + j * y_step, x_step, y_step)
+                 for i in range(x_points - 1) for j in range(y_points - 1)]
+        for depth in range(1, self.adaptive_max_depth + 1):
+            batch, cells = self.refine_cells(cells, threshold, self.adaptive_max_points - len(plan["map_list"]),
+                                             plan["map_list"][-1])
+            if not batch:
+                break
+            print(f"Refining {len(cells) // 4} cells with {len(batch)} new points (depth {depth})")
+            plan["map_list"].extend(batch)
+            self.add_points(batch)
+            for coordinate in batch:
+                if self.mapping_terminated or not self.map_point(self.points_done, coordinate):
+                    return False
+
+        print(f"Mapping finished :) {len(plan['map_list'])} points mapped adaptively")
+        return True
+
+    # Returns the new points to map and the new (4 times smaller) cells of every cell that changes by more than threshold.
+    # Cells with a corner that was not mapped (outside of the region) are not refined. The points are ordered from start.
+    def refine_cells(self, cells, threshold, budget, start):
+        scored = []
+        for x, y, width, height in cells:
+            corners = [self.signals.get(self.point_key(corner)) for corner in
+                       ((x, y), (x + width, y), (x, y + height), (x + width, y + height))]
+            if None in corners:
+                continue
+            change = max(corners) - min(corners)
+            if change > threshold:
+                scored.append((change, (x, y, width, height)))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        batch = []
+        planned = set(self.signals)
+        refined = []
+        for change, (x, y, width, height) in scored:
+            new_points = []
+            for point in ((x + width / 2, y), (x, y + height / 2), (x + width / 2, y + height / 2),
+                          (x + width, y + height / 2), (x + width / 2, y + height)):
+                key = self.point_key(point)
+                if key not in planned:
+                    planned.add(key)
+                    new_points.append(list(key))
+            if len(batch) + len(new_points) > budget:
+                break
+            batch.extend(new_points)
+            half_width, half_height = width / 2, height / 2
+            refined.extend([(x, y, half_width, half_height), (x + half_width, y, half_width, half_height),
+                            (x, y + half_height, half_width, half_height),
+                            (x + half_width, y + half_height, half_width, half_height)])
+        if len(batch) <= self.nearest_max_points:
+            batch = self.order_nearest_neighbour(batch, start)
+        return batch, refined
+
+    # Continuous mapping moves the fast axis at a constant velocity along every line of a raster or serpentine map and
+    # starts an acquisition when the stage crosses a planned point, instead of stopping at every point. The velocity is
+    # one step per expected acquisition time (times continuous_margin), so an acquisition ends before the next point.
+    # The stage starts a bit before the line (and stops a bit after it) to be at full velocity on the whole line.
+    # Every point is logged with the position the stage really had at the trigger, "late" if it was more
+    # than half a step away (the acquisition took longer than expected). Progress is checkpointed after every line.
+    def map_continuous(self, plan, start_index=0):
+        if not self.scans_continuously(plan):
+            print(f"Continuous mapping needs a raster or serpentine path, mapping {plan['path_strategy']} point by point.")
+            return self.map_points(plan["map_list"], start_index)
+        fast = 0 if plan["fast_axis"] == "x" else 1
+        index = 0
+        for line in self.scan_lines(fast, plan["map_list"]):
+            if index < start_index:
+                index += len(line)
+                continue
+            if self.mapping_terminated:
+                return False
+            if len(line) == 1:
+                finished = self.map_point(index, line[0])
+            else:
+                finished = self.scan_line(index, line, fast)
+            if not finished:
+                return False
+            index += len(line)
+            self.save_checkpoint_progress(self.points_done)
+
+        print("Mapping finished :)")
+        return True
+
+    # Lines are the runs of consecutive points with the same slow axis coordinate.
+    def scan_lines(self, fast, points):
+        lines = []
+        for coordinate in points:
+            if lines and round(lines[-1][-1][1 - fast], 6) == round(coordinate[1 - fast], 6):
+                lines[-1].append(coordinate)
+            else:
+                lines.append([coordinate])
+        return lines
+
+    # The scan velocity of a line with points step mm apart and the run-up distance the stage needs to reach it.
+    def scan_velocity(self, fast_stage, step):
+        profile = fast_stage.profiles["gentle"]
+        velocity = min(step / (self.expected_acquisition_time * self.continuous_margin), profile["max_velocity"])
+        return velocity, velocity ** 2 / profile["acceleration"]
+
+    # The first point of a line is timed from the start of the line, so its move time has the move to the start of
+    # the run-up and the run-up in it, like the move to a point of a grid map.
+    def scan_line(self, index, line, fast):
+        line_start = time.monotonic()
+        stages = (self.stage_x, self.stage_y)
+        fast_stage, slow_stage = stages[fast], stages[1 - fast]
+        first, last = line[0][fast], line[-1][fast]
+        direction = 1 if last >= first else -1
+        step = abs(line[1][fast] - line[0][fast])
+        velocity, run_up = self.scan_velocity(fast_stage, step)
+
+        start = list(line[0])
+        start[fast] = min(max(first - direction * run_up, self.travel[0]), self.travel[1])
+        self.move_two_at_once(start)
+        if self.mapping_terminated:
+            return False
+        slow_position = self.actual_position(slow_stage)
+        fast_stage.scan_to(min(max(last + direction * run_up, self.travel[0]), self.travel[1]), velocity)
+
+        for offset, coordinate in enumerate(line):
+            wait_start = time.monotonic() if offset else line_start
+            position = self.wait_for_crossing(fast_stage, coordinate[fast], direction)
+            if position is None:
+                return False
+            self.take_spectrum()
+            move_time = time.monotonic() - wait_start
+            self.move_times.append(move_time)
+            actual = [slow_position, slow_position]
+            actual[fast] = position
+            status = "late" if abs(position - coordinate[fast]) > step / 2 else self.spectro.ready_status
+            try:
+                with metrics.span("acquisition_wait"):
+                    acquisition_time = self.acquisition_waiter.wait()
+            except TimeoutError:
+                self.record_point(index + offset, coordinate, actual, move_time, self.acquisition_waiter.timeout, "timeout")
+                self.mapping_failure = f"Measurement did not finish in {self.acquisition_waiter.timeout} s"
+                print(f"{self.mapping_failure}, mapping stopped.")
+                return False
+            if acquisition_time is None:
+                self.record_point(index + offset, coordinate, actual, move_time, float("nan"), "aborted")
+                return False
+            signal = self.spectro.Signal(actual)
+            self.run_acquisition_times.append(acquisition_time)
+            self.record_point(index + offset, coordinate, actual, move_time, acquisition_time, status, signal)
+            self.points_done += 1
+
+        fast_stage.wait_for_stop(cancel=self.abort_event)
+        print(f"Line of {len(line)} points scanned at {round(velocity,3)} mm/s")
+        return True
+
+    # Returns the position of the stage as soon as it reached target (moving in direction), or None if the mapping
+    # was stopped. If the stage stops before the target (e.g. at the end of its travel) its position is returned.
+    def wait_for_crossing(self, stage, target, direction):
+        while not self.mapping_terminated:
+            position = self.actual_position(stage)
+            if (position - target) * direction >= 0 or not stage.is_moving():
+                return position
+            time.sleep(self.continuous_poll_interval)
+        return None
+
+    def add_points(self, points):
+        self.map_list = self.map_list + points
+        self.map_array = np.asarray(self.map_list, dtype=float).reshape(-1, 2)
+        self.extend_estimate(points, self.run_plan)
+
+    # Both stages move at the same time, so a move takes as long as the slower of the two axes.
+    # move_correction is the average difference between the measured and predicted move times of the last
+    # point by point run (stopping, USB communication etc.), added to every predicted move.
+    # The moves are predicted for the mode and path of plan, by default for the ones set now.
+    def predict_moves(self, points, plan=None):
+        if plan is None:
+            plan = {"mapping_mode": self.mapping_mode, "path_strategy": self.path_strategy, "fast_axis": self.fast_axis}
+        if self.scans_continuously(plan):
+            return self.predict_scan_moves(points, plan["fast_axis"])
+        position = (self.converted_position(self.stage_x), self.converted_position(self.stage_y))
+        times = []
+        for point in points:
+            times.append(self.predict_move(position, point))
+            position = point
+        return times
+
+    def predict_move(self, start, end):
+        return max(self.stage_x.estimate_move_time(abs(end[0] - start[0])),
+                   self.stage_y.estimate_move_time(abs(end[1] - start[1]))) + self.move_correction
+
+    @staticmethod
+    def scans_continuously(plan):
+        return plan["mapping_mode"] == "continuous" and plan["path_strategy"] in ("raster", "serpentine")
+
+    # In continuous mode the first point of a line takes the move to the start of the run-up and the run-up at the
+    # acceleration of the "gentle" profile. Every other point takes what is left of the time the stage needs for
+    # one step at the scan velocity when the acquisition at the point before is done.
+    def predict_scan_moves(self, points, fast_axis):
+        fast = 0 if fast_axis == "x" else 1
+        fast_stage = (self.stage_x, self.stage_y)[fast]
+        acceleration = fast_stage.profiles["gentle"]["acceleration"]
+        acquisition = self.expected_acquisition_time
+        position = (self.converted_position(self.stage_x), self.converted_position(self.stage_y))
+        times = []
+        for line in self.scan_lines(fast, points):
+            if len(line) == 1:
+                times.append(self.predict_move(position, line[0]))
+                position = line[0]
+                continue
+            first, last = line[0][fast], line[-1][fast]
+            direction = 1 if last >= first else -1
+            step = abs(line[1][fast] - line[0][fast])
+            velocity, run_up = self.scan_velocity(fast_stage, step)
+            start = list(line[0])
+            start[fast] = min(max(first - direction * run_up, self.travel[0]), self.travel[1])
+            run_up_time = abs(first - start[fast]) / velocity + velocity / (2 * acceleration)
+            times.append(self.predict_move(position, start) + run_up_time)
+            times.extend([max(step / velocity - acquisition, 0)] * (len(line) - 1))
+            position = line[-1]
+        return times
+
+    @property
+    def expected_acquisition_time(self):
+        expected = self.acquisition_waiter.expected_duration
+        return expected if expected is not None else self.default_acquisition_time
+
+    def estimate_map_time(self, points=None):
+        if points is None:
+            points = self.map_list
+        return sum(self.predict_moves(points)) + len(points) * self.expected_acquisition_time
+
+    # The predicted move times are calculated once at the start of a run. remaining_moves[i] is the time
+    # of all the moves from point i to the end, so the remaining time is cheap to show while mapping.
+    # An adaptive map adds its new points with extend_estimate when they are known.
+    def prepare_estimate(self, plan):
+        self.predicted_moves = []
+        self.extend_estimate(plan["map_list"], plan)
+
+    def extend_estimate(self, points, plan):
+        self.predicted_moves = self.predicted_moves + self.predict_moves(points, plan)
+        self.remaining_moves = [0] * (len(self.predicted_moves) + 1)
+        for i in range(len(self.predicted_moves) - 1, -1, -1):
+            self.remaining_moves[i] = self.remaining_moves[i + 1] + self.predicted_moves[i]
+        self.predicted_total = self.remaining_moves[0] + len(self.predicted_moves) * self.expected_acquisition_time
+
+    def remaining_time(self):
+        if self.run_start is None:
+            return None
+        remaining_points = len(self.run_plan["map_list"]) - self.points_done
+        return self.remaining_moves[self.points_done] + remaining_points * self.expected_acquisition_time
+
+    # After a run the prediction is compared with what really happened and the move correction is updated.
+    # A continuous run does not update it, its move times are mostly the waits for the stage to cross the points.
+    def report_estimate(self, elapsed, plan):
+        done = len(self.move_times)
+        if done == 0:
+            return
+        first = self.run_first_index
+        mapped = self.points_done - first
+        predicted_moves = sum(self.predicted_moves[first:first + done])
+        measured_moves = sum(self.move_times)
+        predicted_acquisitions = self.predicted_total - self.remaining_moves[0]
+        print(f"Map time: predicted {round(self.predicted_total,1)} s for {len(plan['map_list'])} points, "
+              f"took {round(elapsed,1)} s for {mapped} points")
+        print(f"Moves: predicted {round(predicted_moves,1)} s, measured {round(measured_moves,1)} s")
+        print(f"Acquisitions: predicted {round(predicted_acquisitions * mapped / len(plan['map_list']),1)} s, "
+              f"measured {round(sum(self.run_acquisition_times),1)} s")
+        if self.settle_savings:
+            print(f"Settle: {len(self.settle_savings)} moves released within {self.settle_tolerance} mm, "
+                  f"{round(sum(self.settle_savings),2)} s saved")
+        detector_times = self.spectro.timing_summary()
+        if detector_times:
+            print("Detector: " + ", ".join(f"{name} {round(value * 1000,1)} ms" for name, value in detector_times.items()))
+        if not self.scans_continuously(plan):
+            self.move_correction += (measured_moves - predicted_moves) / done
+            self.move_correction = max(self.move_correction, 0)
 
     def get_stages(self):
         return self.stages
+
+    @staticmethod
+    def create_detector(name):
+        if name == "Simulated":
+            return SimulatedDetector(signal=SimulatedDetector.spot((12.5, 12.5), 2.0))
+        detector = Chirascan.shared()
+        detector.connect_in_background()
+        return detector
     
     def converted_position(self,stage):
         return stage.get_position/stage.convert
 
-    def move_two_at_once(self,endlist):
-        self.stage_x.move(endlist[0],check=False,update_now=False)
-        self.stage_y.move(endlist[1],check=False,update_now=False)
+    def actual_position(self,stage):
+        return stage.read_position()/stage.convert
 
-        self.stage_x.wait_for_stop()
-        self.stage_y.wait_for_stop()
+    # While a map is running the waits end as soon as the map is aborted, and with settle_tolerance set
+    # a move is done as soon as both stages are close enough to the target (see wait_for_settle).
+    def move_two_at_once(self,endlist):
+        cancel = self.abort_event if self.run_start is not None else None
+        self.settle_watcher.end()
+        with metrics.span("move_two_at_once"):
+            if self.settle_tolerance is not None and cancel is not None:
+                timeout = max(self.stage_x.estimate_move_time(abs(endlist[0] - self.converted_position(self.stage_x))),
+                              self.stage_y.estimate_move_time(abs(endlist[1] - self.converted_position(self.stage_y))))
+            self.stage_x.move(endlist[0],check=False,update_now=False)
+            self.stage_y.move(endlist[1],check=False,update_now=False)
+
+            if self.settle_tolerance is not None and cancel is not None:
+                if self.wait_for_settle(endlist, timeout + self.settle_timeout, cancel):
+                    return
+            self.stage_x.wait_for_stop(cancel=cancel)
+            self.stage_y.wait_for_stop(cancel=cancel)
+
+    # The controllers end a move with a slow final approach, but the optics only need the stage within
+    # settle_tolerance (mm) of the target. The move is done when both positions stayed that close for settle_dwell
+    # seconds. Returns False if that did not happen in timeout seconds (the caller then waits for the stop as usual).
+    # After an early release settle_watcher waits for the real stop, so settle_saved() can tell how much time was saved.
+    def wait_for_settle(self, target, timeout, cancel):
+        start = time.monotonic()
+        inside_since = None
+        while not cancel.is_set():
+            now = time.monotonic()
+            position = (self.actual_position(self.stage_x), self.actual_position(self.stage_y))
+            if all(abs(p - t) <= self.settle_tolerance for p, t in zip(position, target)):
+                if inside_since is None:
+                    inside_since = now
+                if now - inside_since >= self.settle_dwell:
+                    self.settle_watcher.start(now, cancel)
+                    return True
+            else:
+                inside_since = None
+            if now - start > timeout:
+                print(f"Stages did not settle within {self.settle_tolerance} mm in {round(timeout,2)} s, waiting for the stop.")
+                return False
+            cancel.wait(self.settle_poll_interval)
+        return False
+
+    def stages_moving(self):
+        return self.stage_x.is_moving() or self.stage_y.is_moving()
+
+    # Time between the early release of the last move and the real stop of the stages (until now if they are still
+    # settling), None if the last move was not released early.
+    def settle_saved(self):
+        saved = self.settle_watcher.saved()
+        if saved is not None:
+            self.settle_savings.append(saved)
+        return saved
 
     def move_two_at_once_to_00(self):
         self.stage_x.move(0,check=False,update_now=False)
@@ -500,8 +2023,55 @@ class Mapper():
         self.stage_x.wait_for_stop()
         self.stage_y.wait_for_stop()
     
+    # While a map is running an abort before the acquire click means the acquisition is not started at all.
     def take_spectrum(self):
-        self.spectro.Measurement()
+        cancel = self.abort_event if self.run_start is not None else None
+        if cancel is not None and cancel.is_set():
+            return
+        with metrics.span("take_spectrum"):
+            self.spectro.Measurement(cancel=cancel)
+
+
+# UIEventQueue carries UI updates from the mapping thread to the Tk main loop, because Tk widgets may only be used
+# from the thread that runs mainloop. post() never blocks on the GUI: it only stores the update under a key, so a newer
+# update with the same key (e.g. the marker position) replaces the one that was not drawn yet. The main loop drains
+# the queue with after() at most fps times per second. Updates posted with key=None are never merged.
+class UIEventQueue():
+    def __init__(self, widget, fps=20):
+        self.widget = widget
+        self.interval = max(int(1000 / fps), 1)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.counter = 0
+        self.running = False
+
+    def post(self, key, callback, *args, **kwargs):
+        with self.lock:
+            if key is None:
+                self.counter += 1
+                key = ("event", self.counter)
+            self.pending.pop(key, None)
+            self.pending[key] = (callback, args, kwargs)
+
+    def start(self):
+        self.running = True
+        self.widget.after(self.interval, self.drain)
+
+    def stop(self):
+        self.running = False
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        try:
+            if self.running:
+                self.widget.after(self.interval, self.drain)
+            with metrics.span("ui_update"):
+                for callback, args, kwargs in pending.values():
+                    callback(*args, **kwargs)
+        except tk.TclError:
+            # The window was closed, there is nothing left to update.
+            self.running = False
 
 
 # MapperUI is the class that is responsible for the UI of mapping process. It communicates with Mapper class,
@@ -514,7 +2084,7 @@ class MapperUI(Mapper):
             self.map_size = self.square_count * self.square_size
             self.marker_on_map = 0
             self.mapper = mapper
-            super().__init__(self.mapper.get_stages())
+            super().__init__(self.mapper.get_stages(), detector=self.mapper.spectro)
             self.frame = frame
 
             self.x_range = tk.StringVar(self.frame,"0")
@@ -529,16 +2099,44 @@ class MapperUI(Mapper):
             self.y_points = tk.StringVar(self.frame,"0")
             self.y_points.trace_add("write",self.update_canvas)
 
+            self.path_strategy_var = tk.StringVar(self.frame,self.path_strategy)
+            self.path_strategy_var.trace_add("write",self.update_canvas)
+
+            self.fast_axis_var = tk.StringVar(self.frame,self.fast_axis)
+            self.fast_axis_var.trace_add("write",self.update_canvas)
+
+            self.region_var = tk.StringVar(self.frame,"rectangle")
+            self.region_var.trace_add("write",self.update_canvas)
+
+            self.mapping_mode_var = tk.StringVar(self.frame,self.mapping_mode)
+            self.mapping_mode_var.trace_add("write",self.update_canvas)
+
             self.selected_point = None
+            self.redraw_job = None
+            self.redraw_after_run = False
+            self.redraw_delay = 150
+            self.position_refresh_ms = 200
+            self.raster_threshold = 10000
+            self.point_items = {}
+            self.point_by_item = {}
+            self.point_pool = []
+
+            self.ui_events = UIEventQueue(self.frame)
+            self.ui_events.start()
 
             kill_button = tk.Button(self.frame, text="Kill Mapping", command=self.kill_mapping)
             kill_button.grid(row=5, column=0, padx=10, pady=10)
             self.build_ui()
             self.build_canvas()
             self.update_canvas_marker()
+            self.refresh_position_loop()
 
 
+    # While a map runs the plan is not changed, the fields are used again when it ends.
     def create_map_list(self):
+        if self.mapping_running():
+            self.redraw_after_run = True
+            return
         try:
             x_range = float(self.x_range.get())
             y_range = float(self.y_range.get())
@@ -546,63 +2144,146 @@ class MapperUI(Mapper):
             y_points = int(self.y_points.get())
             self.x_step = x_range/x_points
             self.y_step = y_range/y_points
+            self.path_strategy = self.path_strategy_var.get()
+            self.fast_axis = self.fast_axis_var.get()
+            self.mapping_mode = self.mapping_mode_var.get()
+            # "circle" maps only the circle inscribed in the map rectangle.
+            if self.region_var.get() == "circle":
+                origin = (self.converted_position(self.stage_x), self.converted_position(self.stage_y))
+                self.region = CircleRegion((origin[0] + x_range / 2, origin[1] + y_range / 2), min(x_range, y_range) / 2)
+            else:
+                self.region = None
 
             map_parameters = [x_range,y_range,x_points,y_points]
 
             self.map_list = super().create_map_list(map_parameters)
             self.update_step_label(self.x_step,self.y_step)
+            self.travel_label.config(text=f"{round(self.travel_distance,3)} mm")
+            self.eta_label.config(text=self.format_duration(self.estimate_map_time()))
             
         except:
             print("Input all variables! Grid not created")
 
+    # These methods can run on the mapping thread, so they never touch the widgets directly.
+    # Everything goes through self.ui_events and is drawn by the Tk main loop.
     def move_two_at_once(self, endlist):
-        self.current_task_label.config(text="Moving...")
+        self.post_task("Moving...")
         super().move_two_at_once(endlist)
-        self.update_canvas_marker()
-        self.update_position_labels()
-        self.current_task_label.config(text="Idle")
+        self.post_position_update()
+        self.post_task("Idle")
 
 
     def move_two_at_once_to_00(self):
-        self.current_task_label.config(text="Moving...")
+        self.post_task("Moving...")
         super().move_two_at_once_to_00()
-        self.update_canvas_marker()
-        self.update_position_labels()
-        self.current_task_label.config(text="Idle")
+        self.post_position_update()
+        self.post_task("Idle")
 
     def move_to_position(self, x, y):
-        self.current_task_label.config(text="Moving...")
+        self.post_task("Moving...")
         super().move_to_position(x, y)
-        self.update_canvas_marker()
-        self.update_position_labels()
-        self.current_task_label.config(text="Idle")
+        self.post_position_update()
+        self.post_task("Idle")
+
+    # A resumed map (start_index > 0) keeps the plan from the checkpoint instead of the one in the fields.
+    def start_mapping(self, start_index=0):
+        if self.mapping_running():
+            messagebox.showinfo("Mapping running", "A map is already running. Wait for it to finish or kill it first.")
+            return
+        if start_index == 0:
+            self.create_map_list()
+            if self.points_out_of_bounds():
+                proceed = messagebox.askyesno("Out of bounds!", "Mapping area is out of bounds! Some points will be lost. Proceed anyway?")
+                if proceed == False:
+                    return
+                self.drop_out_of_bounds()
+        super().start_mapping(start_index=start_index)
+
+    def mapping_process(self, start_index=0):
+        self.abort_latency = None
+        super().mapping_process(start_index)
+        self.post_position_update()
+        if self.abort_latency is not None:
+            self.post_task(f"Aborted in {round(self.abort_latency,2)} s")
+        if self.redraw_after_run:
+            self.redraw_after_run = False
+            self.ui_events.post("redraw", self.redraw_after_thread)
+
+    # The mapping thread is still alive while it posts, so the plan from the fields is drawn once it is gone.
+    def redraw_after_thread(self):
+        if self.mapping_running():
+            self.frame.after(50, self.redraw_after_thread)
+        else:
+            self.update_canvas()
 
-    def mapping_process(self):
-        super().mapping_process()
-        self.update_canvas_marker()
-        self.update_position_labels()
+    # New points of an adaptive map are drawn when the pass that maps them starts.
+    def add_points(self, points):
+        super().add_points(points)
+        self.ui_events.post("points", self.draw_point_items)
+
+    def resume_mapping(self):
+        problem = super().resume_mapping()
+        if problem is not None:
+            messagebox.showinfo("Resume Not Possible", problem)
+
+    # Stage positions come from the telemetry cache, so the marker and labels can follow a moving stage.
+    def refresh_position_loop(self):
+        try:
+            self.update_canvas_marker()
+            self.update_position_labels()
+            remaining = self.remaining_time()
+            self.remaining_label.config(text="-" if remaining is None else self.format_duration(remaining))
+            self.frame.after(self.position_refresh_ms, self.refresh_position_loop)
+        except tk.TclError:
+            pass
+
+    def post_task(self, text):
+        self.ui_events.post("task", self.current_task_label.config, text=text)
+
+    def post_position_update(self):
+        self.ui_events.post("marker", self.update_canvas_marker)
+        self.ui_events.post("position labels", self.update_position_labels)
 
 
     def converted_position(self,stage):
         return stage.get_position/stage.convert
 
+    # The grid is drawn with one line per row and column instead of one rectangle per square. Clicks and hover
+    # are handled once for the whole canvas and the square under the pointer is calculated from the pointer position.
     def build_canvas(self):
-        self.map_canvas = tk.Canvas(self.frame, width=int(self.map_size), height=int(self.map_size), bg="white")
+        self.map_canvas = tk.Canvas(self.frame, width=int(self.map_size), height=int(self.map_size), bg="lightgray")
         self.map_canvas.grid(row=0, column=0, padx=10, pady=10)
         self.map_canvas.bind("<Button-1>", self.on_canvas_click)
-
-        for i in range(0, int(self.map_size), int(self.square_size)):
-            for j in range(0, int(self.map_size), int(self.square_size)):
-                square_id = f"square_{i}_{j}"
-                
-                self.map_canvas.create_rectangle(i, j, i + int(self.square_size), j + int(self.square_size),
-                                                 fill="lightgray", outline="black", tags=square_id)
-
-                self.map_canvas.tag_bind(square_id, "<Button-1>", lambda event, x=i, y=j: self.move_to_position(x, y))
-
-                self.map_canvas.tag_bind(square_id, "<Enter>", lambda event, x=i, y=j: self.show_coordinates(x, y))
-
-                self.map_canvas.tag_bind(square_id, "<Leave>", lambda event: self.clear_coordinates())
+        self.map_canvas.bind("<Motion>", self.on_canvas_motion)
+        self.map_canvas.bind("<Leave>", lambda event: self.clear_coordinates())
+        self.map_canvas.tag_bind("planned_point", "<Button-1>", self.on_point_click)
+        self.map_canvas.tag_bind("planned_point", "<Enter>", self.on_point_enter)
+        self.map_canvas.tag_bind("planned_point", "<Leave>", lambda event: self.clear_coordinates())
+
+        step = int(self.square_size)
+        for i in range(0, int(self.map_size) + 1, step):
+            self.map_canvas.create_line(i, 0, i, int(self.map_size), fill="black", tags="grid")
+            self.map_canvas.create_line(0, i, int(self.map_size), i, fill="black", tags="grid")
+
+    def grid_square(self, event):
+        step = int(self.square_size)
+        last = (int(self.map_size) - 1) // step * step
+        x = min(max(int(event.x) // step * step, 0), last)
+        y = min(max(int(event.y) // step * step, 0), last)
+        return x, y
+
+    # Points and the position marker are drawn on top of the grid and have their own bindings,
+    # so the grid only reacts when the pointer is not over any of them.
+    def pointer_on_grid(self):
+        current = self.map_canvas.find_withtag("current")
+        if not current:
+            return True
+        tags = self.map_canvas.gettags(current[0])
+        return "grid" in tags or "points_raster" in tags
+
+    def on_canvas_motion(self, event):
+        if self.pointer_on_grid():
+            self.show_coordinates(*self.grid_square(event))
 
                 
     def build_ui(self):
@@ -665,13 +2346,106 @@ class MapperUI(Mapper):
         self.go_to_00_button = tk.Button(self.frame, text="Go to (0,0)",command=self.move_two_at_once_to_00)
         self.go_to_00_button.grid(row = 7, column=0,padx=10,pady=10)
 
+        self.resume_button = tk.Button(self.frame, text="Resume Mapping",command=self.resume_mapping)
+        self.resume_button.grid(row = 8, column=0,padx=10,pady=10)
+
+        self.stats_button = tk.Button(self.frame, text="Timing stats",command=self.open_stats_panel)
+        self.stats_button.grid(row = 9, column=0,padx=10,pady=10)
+
+        path_strategy_label = tk.Label(self.frame,text="Path:")
+        path_strategy_label.grid(row=7,column=1,padx=10,pady=5,sticky="w")
+        self.path_strategy_menu = tk.OptionMenu(self.frame, self.path_strategy_var, *self.path_strategies)
+        self.path_strategy_menu.grid(row=7, column=2, padx=10, pady=5)
+
+        fast_axis_label = tk.Label(self.frame,text="Fast axis:")
+        fast_axis_label.grid(row=8,column=1,padx=10,pady=5,sticky="w")
+        self.fast_axis_menu = tk.OptionMenu(self.frame, self.fast_axis_var, "x", "y")
+        self.fast_axis_menu.grid(row=8, column=2, padx=10, pady=5)
+
+        travel_label = tk.Label(self.frame,text="Travel:")
+        travel_label.grid(row=9,column=1,padx=10,pady=5,sticky="w")
+        self.travel_label = tk.Label(self.frame, text="0 mm")
+        self.travel_label.grid(row=9, column=2, padx=10, pady=0)
+
+        region_label = tk.Label(self.frame,text="Region:")
+        region_label.grid(row=10,column=1,padx=10,pady=5,sticky="w")
+        self.region_menu = tk.OptionMenu(self.frame, self.region_var, "rectangle", "circle")
+        self.region_menu.grid(row=10, column=2, padx=10, pady=5)
+
+        self.compare_paths_button = tk.Button(self.frame,text="Compare paths",command=self.show_path_comparison)
+        self.compare_paths_button.grid(row=13,column=1,pady=10,padx=10,columnspan=2)
+
+        eta_label = tk.Label(self.frame,text="Map time:")
+        eta_label.grid(row=11,column=1,padx=10,pady=5,sticky="w")
+        self.eta_label = tk.Label(self.frame, text="-")
+        self.eta_label.grid(row=11, column=2, padx=10, pady=0)
+
+        mapping_mode_label = tk.Label(self.frame,text="Mode:")
+        mapping_mode_label.grid(row=14,column=1,padx=10,pady=5,sticky="w")
+        self.mapping_mode_menu = tk.OptionMenu(self.frame, self.mapping_mode_var, *self.mapping_modes)
+        self.mapping_mode_menu.grid(row=14, column=2, padx=10, pady=5)
+
+        remaining_label = tk.Label(self.frame,text="Remaining:")
+        remaining_label.grid(row=12,column=1,padx=10,pady=5,sticky="w")
+        self.remaining_label = tk.Label(self.frame, text="-")
+        self.remaining_label.grid(row=12, column=2, padx=10, pady=0)
+
     def clear_coordinates(self):
         self.coordinates_label.config(text="")
 
+    @staticmethod
+    def format_duration(seconds):
+        minutes, seconds = divmod(int(round(seconds)), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}h {minutes:02d}min {seconds:02d}s"
+
+    def show_path_comparison(self):
+        if self.mapping_running():
+            messagebox.showinfo("Mapping running", "Paths can be compared when the map is finished.")
+            return
+        try:
+            map_parameters = [float(self.x_range.get()),float(self.y_range.get()),int(self.x_points.get()),int(self.y_points.get())]
+        except ValueError:
+            print("Input all variables! Paths not compared")
+            return
+        distances = self.compare_path_strategies(map_parameters)
+        self.map_list = Mapper.create_map_list(self, map_parameters)
+        text = "\n".join(f"{strategy}: skipped, too many points" if distance is None else f"{strategy}: {round(distance,3)} mm"
+                         for strategy, distance in distances.items())
+        messagebox.showinfo("Predicted travel", text)
+
+    # The stats panel turns the timing metrics on and off and shows their histograms, refreshed every second.
+    def open_stats_panel(self):
+        if getattr(self, "stats_window", None) is not None and self.stats_window.winfo_exists():
+            self.stats_window.lift()
+            return
+        self.stats_window = tk.Toplevel(self.frame)
+        self.stats_window.title("Timing stats")
+        self.metrics_enabled_var = tk.BooleanVar(self.stats_window, metrics.enabled)
+        enabled_check = tk.Checkbutton(self.stats_window, text="Measure timings", variable=self.metrics_enabled_var,
+                                       command=self.toggle_metrics)
+        enabled_check.grid(row=0, column=0, padx=10, pady=5, sticky="w")
+        reset_button = tk.Button(self.stats_window, text="Reset", command=metrics.reset)
+        reset_button.grid(row=0, column=1, padx=10, pady=5)
+        self.stats_label = tk.Label(self.stats_window, text="", font=("Courier", 9), justify="left", anchor="w")
+        self.stats_label.grid(row=1, column=0, columnspan=2, padx=10, pady=5, sticky="w")
+        self.refresh_stats_panel()
+
+    def toggle_metrics(self):
+        metrics.enabled = self.metrics_enabled_var.get()
+
+    def refresh_stats_panel(self):
+        try:
+            lines = metrics.summary_lines()
+            self.stats_label.config(text="\n".join(lines) if lines else "No timings yet.")
+            self.stats_window.after(1000, self.refresh_stats_panel)
+        except tk.TclError:
+            pass
+
     def kill_mapping(self):
-        self.mapping_terminated = True
+        self.abort_mapping()
         print("Mapping process has been terminated.")
-        self.current_task_label.config(text="Idle")
+        self.current_task_label.config(text="Stopping...")
 
     def show_coordinates(self, x, y):
         self.coordinates_label.config(text=f"Cursor: X: {x / 10}mm, Y: {y / 10}mm")
@@ -699,20 +2473,86 @@ class MapperUI(Mapper):
         self.y_step_calc.config(text=round(ystep,3))
         
     
+    # update_canvas is called on every keystroke in the entries, so the redraw is delayed until typing stops.
     def update_canvas(self,*args):
+        if self.redraw_job is not None:
+            self.frame.after_cancel(self.redraw_job)
+        self.redraw_job = self.frame.after(self.redraw_delay, self.redraw_points)
+
+    # Planned points are kept in self.point_items (coordinate -> oval) and only the points that changed are
+    # added or removed. Removed ovals are hidden and kept in self.point_pool to be reused by the next redraw.
+    # Plans bigger than raster_threshold are drawn as a single image instead of separate ovals.
+    def redraw_points(self):
+        with metrics.span("redraw_points"):
+            self.draw_planned_points()
+
+    def draw_planned_points(self):
+        self.redraw_job = None
         self.create_map_list()
-        if self.mapping_points_on_map == 1:
-            for id in self.circle_id_list:
-                self.map_canvas.delete(id)
-        for coordinate in self.map_list:
-            x,y = coordinate
-            circle_id = f"circle_{x}_{y}"
-            self.circle_id_list.append(circle_id)
-            self.map_canvas.create_oval(10*x-3,10*y+3,10*x+3,10*y-3,fill="blue",tags=circle_id)
-            self.map_canvas.tag_bind(circle_id, "<Button-1>", lambda event, x=x, y=y: self.move_to_position(10*x, 10*y))
-            self.map_canvas.tag_bind(circle_id, "<Enter>", lambda event, x=x, y=y: self.show_coordinates(x, y))
-            self.map_canvas.tag_bind(circle_id, "<Leave>", lambda event: self.clear_coordinates())
-            self.mapping_points_on_map = 1
+        if len(self.map_list) > self.raster_threshold:
+            self.clear_point_items()
+            self.draw_points_raster()
+        else:
+            self.map_canvas.itemconfigure("points_raster", state="hidden")
+            self.draw_point_items()
+        self.map_canvas.tag_raise("current marker")
+
+    def draw_point_items(self):
+        planned = {self.point_key(coordinate) for coordinate in self.map_list}
+        for key in [key for key in self.point_items if key not in planned]:
+            item = self.point_items.pop(key)
+            del self.point_by_item[item]
+            self.map_canvas.itemconfigure(item, state="hidden")
+            self.point_pool.append(item)
+        for key in planned:
+            if key in self.point_items:
+                continue
+            x, y = key
+            if self.point_pool:
+                item = self.point_pool.pop()
+                self.map_canvas.coords(item, 10*x-3, 10*y+3, 10*x+3, 10*y-3)
+                self.map_canvas.itemconfigure(item, state="normal")
+            else:
+                item = self.map_canvas.create_oval(10*x-3,10*y+3,10*x+3,10*y-3,fill="blue",tags="planned_point")
+            self.point_items[key] = item
+            self.point_by_item[item] = key
+
+    def clear_point_items(self):
+        for item in self.point_items.values():
+            self.map_canvas.itemconfigure(item, state="hidden")
+            self.point_pool.append(item)
+        self.point_items = {}
+        self.point_by_item = {}
+
+    def draw_points_raster(self):
+        size = int(self.map_size)
+        pixels = [["lightgray"] * size for _ in range(size)]
+        for x, y in self.map_list:
+            px, py = int(round(10*x)), int(round(10*y))
+            for row in range(max(py-1, 0), min(py+2, size)):
+                for col in range(max(px-1, 0), min(px+2, size)):
+                    pixels[row][col] = "blue"
+        self.points_image = tk.PhotoImage(master=self.frame, width=size, height=size)
+        self.points_image.put(" ".join("{" + " ".join(row) + "}" for row in pixels))
+        if self.map_canvas.find_withtag("points_raster"):
+            self.map_canvas.itemconfigure("points_raster", image=self.points_image, state="normal")
+        else:
+            self.map_canvas.create_image(0, 0, image=self.points_image, anchor="nw", tags="points_raster")
+            self.map_canvas.tag_raise("points_raster", "grid")
+
+    def point_under_pointer(self):
+        current = self.map_canvas.find_withtag("current")
+        return self.point_by_item.get(current[0]) if current else None
+
+    def on_point_click(self, event):
+        point = self.point_under_pointer()
+        if point is not None:
+            self.move_to_position(10*point[0], 10*point[1])
+
+    def on_point_enter(self, event):
+        point = self.point_under_pointer()
+        if point is not None:
+            self.show_coordinates(*point)
 
 
     def update_position_labels(self):
@@ -721,14 +2561,379 @@ class MapperUI(Mapper):
 
     def on_canvas_click(self, event):
         self.selected_point = (event.x, event.y)
+        if self.pointer_on_grid():
+            self.move_to_position(*self.grid_square(event))
+
+
+# PointRecorder writes one record for every mapped point to a file while the map is running. Records are kept
+# in memory only until chunk_size of them are collected or flush_interval seconds have passed, then they are appended
+# to the file and flushed, so the memory use does not grow with the map and a running map can already be read.
+# Format "csv" is a plain csv file. Format "binary" is a columnar file: a header line with the field names and then
+# chunks, each with the number of records followed by every column as little endian doubles (status as text).
+class PointRecorder():
+    fields = ("index", "timestamp", "x_commanded", "y_commanded", "x_actual", "y_actual", "move_s", "acquisition_s", "signal", "settle_saved_s", "status")
+    magic = b"XYMAPPER-POINTS 1\n"
+
+    def __init__(self, path, format="csv", chunk_size=100, flush_interval=5.0):
+        self.path = path
+        self.format = format
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.chunk = []
+        self.last_flush = time.monotonic()
+        self.records = 0
+        if format == "csv":
+            self.file = open(path, "a", newline="")
+            self.writer = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.writer.writerow(self.fields)
+        else:
+            self.file = open(path, "ab")
+            if self.file.tell() == 0:
+                self.file.write(self.magic)
+                self.file.write((json.dumps(self.fields) + "\n").encode())
+
+    def add(self, **record):
+        self.chunk.append(record)
+        self.records += 1
+        if len(self.chunk) >= self.chunk_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            if self.format == "csv":
+                self.writer.writerows([record.get(field, "") for field in self.fields] for record in self.chunk)
+            else:
+                self.write_binary_chunk()
+            self.chunk = []
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def write_binary_chunk(self):
+        data = bytearray(struct.pack("<I", len(self.chunk)))
+        for field in self.fields[:-1]:
+            data += array("d", (float(record.get(field, "nan")) for record in self.chunk)).tobytes()
+        for record in self.chunk:
+            status = str(record.get("status", "")).encode()
+            data += struct.pack("<H", len(status)) + status
+        self.file.write(data)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    # Reads the records of a log one by one, also while the map is still being written.
+    # A chunk that is not completely written yet is skipped.
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as file:
+            if file.read(len(cls.magic)) != cls.magic:
+                file.seek(0)
+                for record in csv.DictReader(io.TextIOWrapper(file, newline="")):
+                    yield record
+                return
+            fields = json.loads(file.readline())
+            while True:
+                header = file.read(4)
+                if len(header) < 4:
+                    return
+                count = struct.unpack("<I", header)[0]
+                columns = {}
+                for field in fields[:-1]:
+                    raw = file.read(8 * count)
+                    if len(raw) < 8 * count:
+                        return
+                    columns[field] = array("d", raw)
+                statuses = []
+                for _ in range(count):
+                    length = file.read(2)
+                    if len(length) < 2:
+                        return
+                    statuses.append(file.read(struct.unpack("<H", length)[0]).decode())
+                for i in range(count):
+                    record = {field: columns[field][i] for field in fields[:-1]}
+                    record[fields[-1]] = statuses[i]
+                    yield record
+
+
+# AcquisitionWaiter waits for the end of a measurement instead of sleeping a fixed time after each point.
+# It remembers how long the last measurements took and polls the detector status fast only around the expected end,
+# backing off the polling interval otherwise. The first polls (start_grace) are there to see the detector leave
+# the ready state, because right after the click the status can still say 'Ready.'.
+# If cancel (a threading.Event) is set, wait stops polling right away and returns None.
+class AcquisitionWaiter():
+    def __init__(self, get_status, ready_status="Ready.", fast_interval=0.05, slow_interval=1.0, backoff=1.5,
+                 window=0.5, start_grace=2.0, timeout=None, history=20, cancel=None):
+        self.get_status = get_status
+        self.ready_status = ready_status
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.backoff = backoff
+        self.window = window
+        self.start_grace = start_grace
+        self.timeout = timeout
+        self.durations = deque(maxlen=history)
+        self.cancel = cancel
 
+    @property
+    def expected_duration(self):
+        if not self.durations:
+            return None
+        ordered = sorted(self.durations)
+        return ordered[len(ordered) // 2]
+
+    def next_interval(self, elapsed, interval):
+        expected = self.expected_duration
+        if expected is not None:
+            remaining = expected - elapsed
+            if remaining > self.window:
+                return min(remaining - self.window, self.slow_interval)
+            if remaining > -self.window:
+                return self.fast_interval
+        return min(interval * self.backoff, self.slow_interval)
+
+    def wait(self):
+        start = time.monotonic()
+        started = False
+        interval = self.fast_interval
+        while True:
+            elapsed = time.monotonic() - start
+            with metrics.span("GetStatus"):
+                ready = self.get_status() == self.ready_status
+            if not ready:
+                started = True
+            elif started or elapsed >= self.start_grace:
+                # Without a busy status the elapsed time is the grace time, not a measurement time.
+                if started:
+                    self.durations.append(elapsed)
+                return elapsed
+            if self.timeout is not None and elapsed >= self.timeout:
+                raise TimeoutError(f"Measurement not finished after {round(elapsed,2)} s")
+            if started:
+                interval = self.next_interval(elapsed, interval)
+            else:
+                interval = self.fast_interval
+            if self.timeout is not None:
+                interval = min(interval, max(self.timeout - elapsed, 0))
+            if self.cancel is None:
+                time.sleep(interval)
+            elif self.cancel.wait(interval):
+                return None
+
+
+# SettleWatcher waits on its own thread for the real stop of the stages after a move was released early
+# (see Mapper.wait_for_settle). There is only one watch at a time: end stops it and joins its thread, and the Mapper
+# calls it at the start of every move, so a stop is never counted for an older release. A set cancel event
+# (the abort of the map) also ends the watch.
+class SettleWatcher():
+    def __init__(self, is_moving, poll_interval=0.01):
+        self.is_moving = is_moving
+        self.poll_interval = poll_interval
+        self.release = None
+        self.stop_time = None
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self, release, cancel=None):
+        self.end()
+        self.release = release
+        self.stop_time = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(self.done, cancel), daemon=True)
+        self.thread.start()
+
+    def run(self, done, cancel):
+        while not done.is_set() and (cancel is None or not cancel.is_set()):
+            if not self.is_moving():
+                break
+            done.wait(self.poll_interval)
+        self.stop_time = time.monotonic()
+
+    def end(self):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.release = None
+
+    # Seconds from the release to the stop (until now if the stages are still moving), None without a release.
+    def saved(self):
+        if self.release is None:
+            return None
+        stop = self.stop_time if self.stop_time is not None else time.monotonic()
+        return stop - self.release
+
+
+# Detector is the base abstract class for the spectrometers the Mapper can take measurements with.
+# Measurement starts an acquisition and GetStatus returns ready_status when the detector is done.
+# If cancel (a threading.Event) is set before the acquisition is started, Measurement does not start it.
+class Detector(ABC):
+    ready_status = "Ready."
+
+    @abstractmethod
+    def Measurement(self, cancel=None):
+        pass
+
+    @abstractmethod
+    def GetStatus(self):
+        pass
+
+    @abstractmethod
+    def SetupWavelength(self, low, high, steps):
+        pass
+
+    @abstractmethod
+    def SampleName(self, name, bg):
+        pass
+
+    # Stops a running acquisition, used when a map is aborted.
+    def StopMeasurement(self):
+        pass
+
+    # One number describing the last measurement (e.g. the intensity at one wavelength), used by the adaptive mapping.
+    # position is where the stages were (in mm). Detectors that cannot read their data return None.
+    def Signal(self, position):
+        return None
+
+    # Average time in seconds of the detector operations, if the detector measures them.
+    def timing_summary(self):
+        return {}
+
+
+# SimulatedDetector is a detector without any hardware, so mapping can be run and timed on any computer.
+# Every acquisition takes acquisition_time seconds plus a random jitter (standard deviation in seconds).
+# With probability failure_rate an acquisition hangs and never gets ready, like a stuck Chirascan.
+# signal is a function (x, y) -> value in mm that plays the sample, so the adaptive mapping can be tried without one.
+class SimulatedDetector(Detector):
+    def __init__(self, acquisition_time=1.0, jitter=0.1, failure_rate=0.0, signal=None):
+        self.acquisition_time = acquisition_time
+        self.signal = signal
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.finish_time = 0
+        self.failed = False
+        self.measurements = 0
+        self.wavelength = None
+        self.sample_name = None
+
+    def Measurement(self, cancel=None):
+        if cancel is not None and cancel.is_set():
+            return
+        self.measurements += 1
+        self.failed = random.random() < self.failure_rate
+        duration = max(random.gauss(self.acquisition_time, self.jitter) if self.jitter else self.acquisition_time, 0)
+        self.finish_time = time.monotonic() + duration
+
+    def GetStatus(self):
+        if self.failed or time.monotonic() < self.finish_time:
+            return "Measuring..."
+        return self.ready_status
+
+    def SetupWavelength(self, low, high, steps):
+        self.wavelength = (float(low), float(high), float(steps))
+
+    def SampleName(self, name, bg):
+        self.sample_name = (name, bg)
+
+    def StopMeasurement(self):
+        self.finish_time = 0
+        self.failed = False
+
+    def Signal(self, position):
+        if self.signal is None:
+            return None
+        return self.signal(*position)
+
+    # A synthetic sample: a gaussian spot with the given center and width (standard deviation) in mm.
+    @staticmethod
+    def spot(center, width, height=1.0):
+        def signal(x, y):
+            return height * math.exp(-((x - center[0]) ** 2 + (y - center[1]) ** 2) / (2 * width ** 2))
+        return signal
+
+
+# Chirascan connects to the running Chirascan.exe only when it is used for the first time (or in the background
+# with connect_in_background), so opening the Mapper never waits for it. Chirascan.shared() returns one session
+# that is reused by every Mapper.
+class Chirascan(Detector):
+    path = r"C:\Program Files (x86)\Applied Photophysics\Chirascan\Chirascan.exe"
+    _shared = None
+
+    # Window and control wrappers are looked up once (see control()) and reused while their window handle is valid.
+    controls = {
+        "main": (None, None),
+        "ProData": ("ProData", None),
+        "status": (None, 1492),
+        "acquire": ("ProData", 1135),
+        "background": ("ProData", 1502),
+        "low wavelength": ("ProData", 2650),
+        "high wavelength": ("ProData", 2649),
+        "wavelength step": ("ProData", 2651),
+        "set wavelength": ("ProData", 2656),
+    }
 
-class Chirascan():
     def __init__(self):
-        self.app = pywinauto.Application(backend = "win32").connect(path = "C:\Program Files (x86)\Applied Photophysics\Chirascan\Chirascan.exe")
-        self.ProDataChirascan = self.app.ProDataChirascan
+        self._app = None
+        self.connect_lock = threading.Lock()
+        self.handles = {}
+        self.call_times = {}
         # self.ChirascanPomiar = self.app.window(title_re = self.a )
 
+    @classmethod
+    def shared(cls):
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def connect(self):
+        with self.connect_lock:
+            if self._app is None:
+                self._app = pywinauto.Application(backend = "win32").connect(path = self.path)
+        return self._app
+
+    def connect_in_background(self):
+        def connect():
+            try:
+                self.connect()
+            except Exception as e:
+                print(f"Could not connect to Chirascan: {e}")
+        threading.Thread(target=connect, daemon=True).start()
+
+    @property
+    def app(self):
+        return self.connect()
+
+    @property
+    def ProDataChirascan(self):
+        return self.app.ProDataChirascan
+
+    # Returns the wrapper of a window or control from self.controls. Searching windows with pywinauto is slow,
+    # so the wrapper is kept and only searched again when its window handle is not valid anymore
+    # (e.g. the window was closed and opened again).
+    def control(self, name):
+        wrapper = self.handles.get(name)
+        if wrapper is not None and handleprops.iswindow(wrapper.handle):
+            return wrapper
+        start = time.perf_counter()
+        window, control_id = self.controls[name]
+        if window == "ProData":
+            specification = self.app.ProDataChirascan
+        else:
+            specification = self.app.window(title_re = '.*Chirascan')
+        if control_id is not None:
+            specification = specification.child_window(control_id = control_id)
+        wrapper = specification.wrapper_object()
+        self.handles[name] = wrapper
+        self.record_time(f"find {name}", start)
+        return wrapper
+
+    def record_time(self, name, start):
+        self.call_times.setdefault(name, deque(maxlen=100)).append(time.perf_counter() - start)
+
+    # Average time of the last calls of every Chirascan operation, to see the automation overhead per point.
+    def timing_summary(self):
+        return {name: sum(times) / len(times) for name, times in self.call_times.items() if times}
+
     def CheckIfDone(self,func,target):
         if self.ProDataChirascan.exists():
             print("Measurement done. Exiting loop.")
@@ -740,28 +2945,27 @@ class Chirascan():
         
             
     def UnminimizeWindow(self,application):
-        self.a = f'.*Chirascan'
-        self.okno = self.app.window(title_re = self.a )
         if application.is_minimized():
             application.restore()
         application.set_focus()
 
-    def Measurement(self):
-        self.a = f'.*Chirascan'
-        
-        self.okno = self.app.window(title_re = self.a )
-        time.sleep(0.5)
+    def Measurement(self, cancel=None):
+        start = time.perf_counter()
+        if cancel is None:
+            time.sleep(0.5)
+        elif cancel.wait(0.5):
+            return
         try:
-            self.UnminimizeWindow(self.okno)
+            self.UnminimizeWindow(self.control("main"))
         except:
-            self.UnminimizeWindow(self.ProDataChirascan)
-        self.acquire = self.app.ProDataChirascan.child_window(control_id = 1135)
-        self.acquire.click_input()
+            self.UnminimizeWindow(self.control("ProData"))
+        self.control("acquire").click_input()
+        self.record_time("Measurement", start)
 
-    # def StopMeasurement(self):
-    #     self.UnminimizeWindow(self.ChirascanPomiar)
-    #     self.stop = self.app.window(title_re = self.a ).child_window(control_id = 1135)
-    #     self.stop.click_input()
+    # While measuring, the acquire button stops the measurement.
+    def StopMeasurement(self):
+        if self.GetStatus() != self.ready_status:
+            self.control("acquire").click_input()
 
     # def PauseMeasurement(self):
     #     self.UnminimizeWindow(self.ChirascanPomiar)
@@ -769,7 +2973,7 @@ class Chirascan():
     #     self.pause.click_input()
 
     def SampleName(self,name, bg):
-        self.UnminimizeWindow(self.ProDataChirascan)
+        self.UnminimizeWindow(self.control("ProData"))
         self.app.ProDataChirascan.type_keys("%")
         self.app.ProDataChirascan.type_keys("{RIGHT 2}""~""{DOWN 2}""~")
         self.app.Preferences.type_keys("{TAB 5}""{RIGHT 5}")
@@ -780,18 +2984,17 @@ class Chirascan():
         self.app.Preferences.child_window(title = "OK", class_name = "Button").click_input()
 
     def BackgroundMeasurement(self):
-        self.UnminimizeWindow(self.ProDataChirascan)
+        self.UnminimizeWindow(self.control("ProData"))
         # try:
             # for t in range(0,len(self.app.ProDataChirascan.children(title=bg, class_name="Button"))):
-        self.background_button = self.app.ProDataChirascan.child_window(control_id = 1502)
-        self.background_button.click_input()
+        self.control("background").click_input()
 
 
     def SetupWavelength(self,low,high,steps):  #connect z przciskiem
-        self.UnminimizeWindow(self.ProDataChirascan)
-        self.low_wl = self.app.ProDataChirascan.child_window(control_id = 2650)
-        self.high_wl = self.app.ProDataChirascan.child_window(control_id = 2649)
-        self.step = self.app.ProDataChirascan.child_window(control_id = 2651)
+        self.UnminimizeWindow(self.control("ProData"))
+        self.low_wl = self.control("low wavelength")
+        self.high_wl = self.control("high wavelength")
+        self.step = self.control("wavelength step")
 
         try:
             self.low_wl.set_text(str(float(low)))
@@ -805,13 +3008,12 @@ class Chirascan():
             self.step.set_text(str(float(steps)))
         except Exception:
             print('Error - Increment setup - please select increment manually')
-        self.set4 = self.app.ProDataChirascan.child_window(control_id = 2656).click_input()
+        self.set4 = self.control("set wavelength").click_input()
 
     def GetStatus(self):
-        self.a = f'.*Chirascan'
-        self.okno = self.app.window(title_re = self.a )
-        self.status = self.okno.child_window(control_id = 1492)
-        self.text = self.status.window_text()
+        start = time.perf_counter()
+        self.text = self.control("status").window_text()
+        self.record_time("GetStatus", start)
         return(self.text)
 
     def ConfirmDone(self):
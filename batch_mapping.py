@@ -0,0 +1,309 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Stage_XYMapper_final_ZPS import (Mapper, ThorlabsStage, VirtualStage, Thorlabs, LazyModule, CircleRegion,
+                                      PolygonRegion, BitmapRegion)
+
+
+yaml = LazyModule("yaml")
+
+
+###/////////////////////////////-Batch-Mapping-///////////////////////////////////////////
+
+# This script runs maps without any window, one after another, from a job file (JSON or YAML), e.g. several
+# samples or regions overnight. Example (all positions and sizes in mm, see also example_jobs.json):
+#
+# {
+#     "stages": {"x": "27000001", "y": "27000002"},      ("virtual" for two virtual stages)
+#     "detector": "Chirascan",                            ("Simulated" for the simulated detector)
+#     "results_dir": "map_results/batch",
+#     "defaults": {"path": "serpentine", "fast_axis": "y"},
+#     "jobs": [
+#         {"name": "sample_A", "start": [5, 5], "parameters": [2, 2, 21, 21],
+#          "wavelength": [200, 260, 1], "sample_name": "sampleA", "background_name": "bg"},
+#         {"name": "sample_B", "start": [15, 5], "parameters": [4, 4, 21, 21], "mode": "continuous",
+#          "region": {"circle": {"center": [17, 7], "radius": 2}}}
+#     ]
+# }
+#
+# Every job is a map of "parameters" (x range, y range, x points, y points) starting at "start". Optional keys:
+# "path", "fast_axis", "mode" (grid, adaptive, continuous), "settle_tolerance", "region" (circle, polygon or bitmap,
+# in stage coordinates), "wavelength" ([low, high, step] for Chirascan.SetupWavelength) and "sample_name" /
+# "background_name" (for Chirascan.SampleName) and "acquisition_timeout" (s, a measurement that takes longer fails the job
+# instead of stopping the queue forever). Keys in "defaults" are used for every job that does not set them.
+# The point log and checkpoint of every job are saved in results_dir/<job name>, the state of all the jobs
+# in results_dir/batch_status.json.
+
+class MapJob():
+    def __init__(self, name, parameters, start=None, path="serpentine", fast_axis="y", mode="grid", region=None,
+                 settle_tolerance=None, wavelength=None, sample_name=None, background_name="bg", acquisition_timeout=None):
+        self.name = name
+        self.parameters = parameters
+        self.start = start
+        self.path = path
+        self.fast_axis = fast_axis
+        self.mode = mode
+        self.region = region
+        self.settle_tolerance = settle_tolerance
+        self.wavelength = wavelength
+        self.sample_name = sample_name
+        self.background_name = background_name
+        self.acquisition_timeout = acquisition_timeout
+
+    @classmethod
+    def from_dict(cls, data, defaults=None, number=0):
+        values = dict(defaults or {})
+        values.update(data)
+        if "parameters" not in values:
+            raise ValueError(f"Job {values.get('name', number)} has no parameters (x range, y range, x points, y points)")
+        x_range, y_range, x_points, y_points = values["parameters"]
+        return cls(name=str(values.get("name", f"job{number}")),
+                   parameters=[float(x_range), float(y_range), int(x_points), int(y_points)],
+                   start=values.get("start"),
+                   path=values.get("path", "serpentine"),
+                   fast_axis=values.get("fast_axis", "y"),
+                   mode=values.get("mode", "grid"),
+                   region=region_from_dict(values.get("region")),
+                   settle_tolerance=values.get("settle_tolerance"),
+                   wavelength=values.get("wavelength"),
+                   sample_name=values.get("sample_name"),
+                   background_name=values.get("background_name", "bg"),
+                   acquisition_timeout=values.get("acquisition_timeout"))
+
+
+def region_from_dict(data):
+    if not data:
+        return None
+    if "circle" in data:
+        return CircleRegion(data["circle"]["center"], data["circle"]["radius"])
+    if "polygon" in data:
+        return PolygonRegion(data["polygon"])
+    if "bitmap" in data:
+        bitmap = data["bitmap"]
+        return BitmapRegion(bitmap["mask"], bitmap["origin"], bitmap["pixel_size"])
+    raise ValueError(f"Unknown region {list(data)}, use circle, polygon or bitmap")
+
+
+def load_job_file(path):
+    with open(path) as file:
+        if path.endswith((".yaml", ".yml")):
+            return yaml.safe_load(file)
+        return json.load(file)
+
+
+def load_jobs(config):
+    defaults = config.get("defaults", {})
+    return [MapJob.from_dict(job, defaults, number) for number, job in enumerate(config.get("jobs", []))]
+
+
+# Opens the two stages of the job file. Controllers are opened and homed at the same time, like in Stage_app.
+def open_stages(stages):
+    if stages == "virtual":
+        return [VirtualStage(id=f"VStage{i}", col=i + 1, frame=None, state="normal") for i in range(2)]
+    serials = [str(serial) for serial in (stages["x"], stages["y"])]
+    connected = [device[0] for device in Thorlabs.list_kinesis_devices()]
+    missing = [serial for serial in serials if serial not in connected]
+    if missing:
+        raise RuntimeError(f"Stages {missing} are not connected, found: {connected}")
+    opened = [ThorlabsStage(id=serial, col=i + 1, frame=None, state="normal") for i, serial in enumerate(serials)]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for future in [pool.submit(stage.connect) for stage in opened]:
+            future.result()
+    return opened
+
+
+# JobQueue runs the jobs one after another with one Mapper. Before a job the stages travel to its start while the
+# detector is set up for it (wavelength range and sample name), so the setup does not add to the travel time.
+# A job that fails (an error, or a map that stopped by itself, e.g. after a measurement timeout) is marked as failed
+# and the next one starts, unless stop_on_error is set.
+# With resume, the jobs that are done in batch_status.json are skipped and a job with an interrupted map
+# (a checkpoint in its folder) is continued instead of started again.
+class JobQueue():
+    def __init__(self, mapper, results_dir, resume=False, stop_on_error=False):
+        self.mapper = mapper
+        self.results_dir = results_dir
+        self.resume = resume
+        self.stop_on_error = stop_on_error
+        self.status = {}
+        self.aborted = False
+        self.default_acquisition_timeout = mapper.acquisition_waiter.timeout
+
+    def run(self, jobs):
+        previous = self.load_status() if self.resume else {}
+        self.status = {job.name: {"state": "pending"} for job in jobs}
+        for job in jobs:
+            if previous.get(job.name, {}).get("state") == "done":
+                self.status[job.name] = previous[job.name]
+        self.save_status()
+        for job in jobs:
+            if self.aborted:
+                break
+            if self.status[job.name]["state"] == "done":
+                print(f"Job {job.name} is already done, skipped")
+                continue
+            self.set_status(job, "running", started=time.time())
+            try:
+                finished = self.run_job(job)
+            except KeyboardInterrupt:
+                # Ctrl+C while the stages travel to the start or the detector is set up.
+                print("Aborting...")
+                self.aborted = True
+                self.mapper.abort_mapping()
+                self.set_status(job, "aborted", ended=time.time())
+                break
+            except Exception as e:
+                print(f"Job {job.name} failed: {e}")
+                self.set_status(job, "failed", error=str(e), ended=time.time())
+                if self.stop_on_error:
+                    break
+                continue
+            self.set_status(job, "done" if finished else "aborted", ended=time.time(),
+                            points=self.mapper.points_done, log=getattr(self.mapper.recorder, "path", None))
+        return self.status
+
+    def run_job(self, job):
+        mapper = self.mapper
+        self.configure(job)
+        print(f"Job {job.name}: {job.parameters[2]}x{job.parameters[3]} points, {job.mode} mode")
+        if self.resume:
+            plan, completed = mapper.load_checkpoint()
+            if plan is not None and mapper.check_resume(plan, completed) is None:
+                self.setup_detector(job)
+                mapper.resume_mapping()
+                return self.wait_for_mapping()
+
+        self.prepare(job)
+        mapper.create_map_list(job.parameters, origin=job.start)
+        if mapper.points_out_of_bounds():
+            mapper.drop_out_of_bounds()
+            print(f"Job {job.name}: points out of the stage travel were dropped")
+        if not mapper.map_list:
+            raise ValueError("the map has no points")
+        print(f"Job {job.name}: {len(mapper.map_list)} points, predicted {round(mapper.estimate_map_time())} s")
+        mapper.start_mapping()
+        return self.wait_for_mapping()
+
+    def configure(self, job):
+        mapper = self.mapper
+        mapper.path_strategy = job.path
+        mapper.fast_axis = job.fast_axis
+        mapper.mapping_mode = job.mode
+        mapper.region = job.region
+        mapper.settle_tolerance = job.settle_tolerance
+        timeout = job.acquisition_timeout if job.acquisition_timeout is not None else self.default_acquisition_timeout
+        mapper.acquisition_waiter.timeout = timeout
+        mapper.results_dir = os.path.join(self.results_dir, job.name)
+        mapper.recorder = None
+
+    # The stages move to the start of the job on a thread while the detector is set up on this one.
+    def prepare(self, job):
+        if job.start is None:
+            self.setup_detector(job)
+            return
+        errors = []
+
+        def move():
+            try:
+                self.mapper.move_two_at_once(job.start)
+            except Exception as e:
+                errors.append(e)
+
+        mover = threading.Thread(target=move, daemon=True)
+        mover.start()
+        self.setup_detector(job)
+        mover.join()
+        if errors:
+            raise errors[0]
+
+    def setup_detector(self, job):
+        detector = self.mapper.spectro
+        if job.wavelength is not None:
+            detector.SetupWavelength(*job.wavelength)
+        if job.sample_name is not None:
+            detector.SampleName(job.sample_name, job.background_name)
+
+    # Waits for the mapping thread. Ctrl+C aborts the map (and the jobs after it).
+    # An exception on the mapping thread is raised here, so the job is marked as failed. So is a map that stopped
+    # before its end without an abort.
+    def wait_for_mapping(self):
+        thread = self.mapper.mapping_thread
+        try:
+            while thread.is_alive():
+                thread.join(0.5)
+        except KeyboardInterrupt:
+            print("Aborting...")
+            self.aborted = True
+            self.mapper.abort_mapping()
+            thread.join()
+        if self.mapper.mapping_error is not None:
+            raise self.mapper.mapping_error
+        if self.mapper.mapping_terminated:
+            return False
+        if self.mapper.points_done < len(self.mapper.map_list):
+            raise RuntimeError(self.mapper.mapping_failure or "the map stopped before its end")
+        return True
+
+    def set_status(self, job, state, **values):
+        self.status[job.name].update(values, state=state)
+        self.save_status()
+
+    def load_status(self):
+        try:
+            with open(os.path.join(self.results_dir, "batch_status.json")) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_status(self):
+        self.mapper.write_json(os.path.join(self.results_dir, "batch_status.json"), self.status)
+
+
+def dry_run(mapper, jobs):
+    total = 0
+    for job in jobs:
+        JobQueue(mapper, "").configure(job)
+        mapper.create_map_list(job.parameters, origin=job.start)
+        predicted = mapper.estimate_map_time()
+        total += predicted
+        out_of_bounds = " (some points out of the stage travel)" if mapper.points_out_of_bounds() else ""
+        print(f"{job.name}: {len(mapper.map_list)} points, {job.mode} mode, predicted {round(predicted)} s{out_of_bounds}")
+    print(f"All jobs: predicted {round(total)} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs XYMapper maps from a job file without any window.")
+    parser.add_argument("jobs", help="job file (.json, or .yaml/.yml with PyYAML installed)")
+    parser.add_argument("--resume", action="store_true", help="continue interrupted maps from their checkpoints")
+    parser.add_argument("--stop-on-error", action="store_true", help="do not start the next job after a failed one")
+    parser.add_argument("--dry-run", action="store_true", help="only print the number of points and predicted times")
+    args = parser.parse_args()
+
+    config = load_job_file(args.jobs)
+    jobs = load_jobs(config)
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        parser.error("job names must be unique, every job saves its results in a folder with its name")
+    results_dir = config.get("results_dir", os.path.join(os.path.dirname(os.path.abspath(__file__)), "map_results", "batch"))
+
+    stages = open_stages(config.get("stages", "virtual"))
+    try:
+        for stage in stages:
+            stage.wait_for_stop()
+        mapper = Mapper(stages, detector=Mapper.create_detector(config.get("detector", "Chirascan")))
+        if args.dry_run:
+            dry_run(mapper, jobs)
+            return
+        status = JobQueue(mapper, results_dir, resume=args.resume, stop_on_error=args.stop_on_error).run(jobs)
+        for name, job_status in status.items():
+            print(f"{name}: {job_status['state']}")
+    finally:
+        for stage in stages:
+            stage.stage_close()
+
+
+if __name__ == "__main__":
+    main()
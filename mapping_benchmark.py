@@ -0,0 +1,191 @@
+from __future__ import annotations
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from Stage_XYMapper_final_ZPS import Mapper, VirtualStage, SimulatedDetector, metrics
+
+
+###/////////////////////////////-Mapping-Benchmark-///////////////////////////////////////////
+
+# This script measures how fast the mapping loop is. It maps with two virtual stages and the simulated detector,
+# without opening any window, so it can be run on any computer before and after a change to the Mapper.
+# Virtual stages move in real time, so a run takes as long as the same map would take on the real setup.
+
+# Each scan is (x range, y range, x points, y points) in mm, the point where the map starts and the path strategy.
+# Continuous scans map the same points without stopping at them, so they can be compared with the stop-and-go ones.
+# Adaptive scans refine the grid up to "depth" times around a simulated gaussian spot (center and width in mm).
+SCANS = {
+    "small_dense": {"parameters": (0.5, 0.5, 11, 11), "start": (5, 5), "path": "serpentine"},
+    "small_dense_continuous": {"parameters": (0.5, 0.5, 11, 11), "start": (5, 5), "path": "serpentine",
+                               "mode": "continuous"},
+    "large_sparse": {"parameters": (20, 20, 5, 5), "start": (2, 2), "path": "serpentine"},
+    "long_travel": {"parameters": (20, 20, 2, 4), "start": (2, 2), "path": "raster"},
+    "adaptive_spot": {"parameters": (8, 8, 5, 5), "start": (2, 2), "path": "serpentine",
+                      "mode": "adaptive", "depth": 2, "spot": ((6.5, 5.5), 1.0)},
+}
+
+
+# BenchmarkMapper is a Mapper that also splits the time of every point into phases:
+# move - the time the stages need by the trapezoidal profile, settle - the rest of the time until both stages
+# reported a stop, acquire - the time the simulated detector really measured, poll - the time until the
+# acquisition waiter noticed that the detector is ready.
+class BenchmarkMapper(Mapper):
+    def __init__(self, stages, detector):
+        super().__init__(stages, detector=detector)
+        self.phases = []
+        wait = self.acquisition_waiter.wait
+
+        def timed_wait():
+            elapsed = wait()
+            done = time.monotonic()
+            phase = self.phases[-1]
+            phase["acquire"] = self.spectro.finish_time - self.trigger_time
+            phase["poll"] = done - self.spectro.finish_time
+            phase["total"] = done - phase.pop("start")
+            return elapsed
+
+        self.acquisition_waiter.wait = timed_wait
+
+    def move_two_at_once(self, endlist):
+        predicted = max(self.stage_x.estimate_move_time(abs(endlist[0] - self.converted_position(self.stage_x))),
+                        self.stage_y.estimate_move_time(abs(endlist[1] - self.converted_position(self.stage_y))))
+        start = time.monotonic()
+        super().move_two_at_once(endlist)
+        measured = time.monotonic() - start
+        self.phases.append({"start": start, "move": min(predicted, measured), "settle": max(measured - predicted, 0)})
+
+    # In continuous mode the stages do not stop at the points, the move is the time until the stage crossed the point.
+    # The first point of a line also includes the move to the start of the line.
+    def wait_for_crossing(self, stage, target, direction):
+        start = time.monotonic()
+        position = super().wait_for_crossing(stage, target, direction)
+        if self.phases and "start" in self.phases[-1]:
+            self.phases[-1]["move"] += time.monotonic() - start
+        else:
+            self.phases.append({"start": start, "move": time.monotonic() - start, "settle": 0})
+        return position
+
+    def take_spectrum(self):
+        self.trigger_time = time.monotonic()
+        super().take_spectrum()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    index = (len(ordered) - 1) * q / 100
+    low = int(index)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (index - low)
+
+
+def run_scan(name, scan, acquisition_time, jitter, settle_tolerance=None):
+    stage_x = VirtualStage(id="BenchX", col=1, frame=None, state="normal")
+    stage_y = VirtualStage(id="BenchY", col=2, frame=None, state="normal")
+    for stage, position in zip((stage_x, stage_y), scan["start"]):
+        stage.wait_for_stop()
+        stage.move(position, check=False, update_now=False)
+        stage.wait_for_stop()
+
+    signal = SimulatedDetector.spot(*scan["spot"]) if "spot" in scan else None
+    detector = SimulatedDetector(acquisition_time=acquisition_time, jitter=jitter, signal=signal)
+    mapper = BenchmarkMapper([stage_x, stage_y], detector)
+    mapper.path_strategy = scan["path"]
+    mapper.settle_tolerance = settle_tolerance
+    mapper.mapping_mode = scan.get("mode", "grid")
+    mapper.adaptive_max_depth = scan.get("depth", mapper.adaptive_max_depth)
+    mapper.default_acquisition_time = acquisition_time
+    mapper.create_map_list(list(scan["parameters"]))
+    mapper.mapping_terminated = False
+    predicted = mapper.estimate_map_time()
+
+    # The point log and checkpoint of the run are only needed while it runs.
+    with tempfile.TemporaryDirectory(prefix="mapping_benchmark_") as results_dir:
+        mapper.results_dir = results_dir
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            mapper.mapping_process()
+        elapsed = time.monotonic() - start
+
+    points = len(mapper.phases)
+    totals = [phase["total"] for phase in mapper.phases]
+    # Number of points of a uniform grid with the finest step of the map.
+    x_range, y_range, x_points, y_points = scan["parameters"]
+    subdivisions = 2 ** mapper.adaptive_max_depth if mapper.mapping_mode == "adaptive" else 1
+    return {
+        "scan": name,
+        "points": points,
+        "fine_grid_points": ((x_points - 1) * subdivisions + 1) * ((y_points - 1) * subdivisions + 1),
+        "elapsed_s": elapsed,
+        "predicted_s": predicted,
+        "points_per_hour": points / elapsed * 3600 if elapsed else 0,
+        "travel_mm": mapper.travel_distance,
+        "settle_saved_s": sum(mapper.settle_savings),
+        "phases_s": {phase: sum(p[phase] for p in mapper.phases) for phase in ("move", "settle", "acquire", "poll")},
+        "latency_s": {f"p{q}": percentile(totals, q) for q in (50, 90, 99)},
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def print_result(result):
+    phases = result["phases_s"]
+    latency = result["latency_s"]
+    print(f"{result['scan']}: {result['points']} points in {round(result['elapsed_s'],1)} s "
+          f"(predicted {round(result['predicted_s'],1)} s), {round(result['points_per_hour'])} points/h, "
+          f"travel {round(result['travel_mm'],2)} mm, uniform grid with the same detail: {result['fine_grid_points']} points")
+    print("    phases: " + ", ".join(f"{name} {round(value,2)} s" for name, value in phases.items()))
+    if result["settle_saved_s"]:
+        print(f"    early settle release saved {round(result['settle_saved_s'],2)} s")
+    print("    point latency: " + ", ".join(f"{name} {round(value,3)} s" for name, value in latency.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the XYMapper mapping loop on virtual stages.")
+    parser.add_argument("--scans", nargs="+", choices=list(SCANS), default=list(SCANS))
+    parser.add_argument("--acquisition-time", type=float, default=0.2, help="simulated acquisition time in s")
+    parser.add_argument("--jitter", type=float, default=0.02, help="standard deviation of the acquisition time in s")
+    parser.add_argument("--stage-settle", type=float, default=0.0,
+                        help="time in s the virtual stages report moving after reaching the target (final approach)")
+    parser.add_argument("--settle-tolerance", type=float, default=None,
+                        help="end moves when the stages are this close to the target in mm instead of waiting for the stop")
+    parser.add_argument("--metrics", default=None,
+                        help="measure the timing spans and export them to this file (.prom or JSON lines)")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="results are appended to this file")
+    args = parser.parse_args()
+
+    VirtualStage.homing_time = 0
+    VirtualStage.settle_time = args.stage_settle
+    metrics.enabled = args.metrics is not None
+    run = {"timestamp": time.time(), "version": git_version(), "python": platform.python_version(),
+           "acquisition_time": args.acquisition_time, "jitter": args.jitter, "stage_settle": args.stage_settle,
+           "settle_tolerance": args.settle_tolerance, "results": []}
+    for name in args.scans:
+        result = run_scan(name, SCANS[name], args.acquisition_time, args.jitter, args.settle_tolerance)
+        print_result(result)
+        run["results"].append(result)
+    if metrics.enabled:
+        print("\n".join(metrics.summary_lines()))
+        metrics.export(args.metrics)
+        print(f"Timing metrics saved to {args.metrics}")
+
+    with open(args.output, "a") as file:
+        file.write(json.dumps(run) + "\n")
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()